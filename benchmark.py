@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+"""
+benchmarks the walle hot paths at several panel sizes against FakeDisplay and FakeSpiDev, e.g.:
+
+    ./benchmark.py --save baseline.json
+    ./benchmark.py --baseline baseline.json --threshold 0.2
+
+each benchmark reports its per-frame latency distribution and frames per second. with --baseline,
+any benchmark whose median latency regressed by more than the threshold fails the run.
+"""
+
+import argparse
+from brian_eno_meditation import Splasher
+import conway_game_of_life
+from conway_game_of_life import ConwayGameOfLifeDisplay
+import json
+import logging
+from matrix_rain import MatrixRain
+import numpy as np
+import re
+import socket
+import sys
+import time
+import walle
+
+DEFAULT_SIZES = (10, 32, 64, 128)
+PERCENTILES = (50, 90, 99)
+
+def _random_frame(size):
+    return np.random.rand(size, size, 3).astype(np.float32)
+
+def bench_pack_udp(size):
+    frame = _random_frame(size)
+    return lambda: walle._pack_udp(frame, 0)
+
+def bench_unpack_udp(size):
+    data = walle._pack_udp(_random_frame(size), 0)
+    return lambda: walle._unpack_udp(data)
+
+def bench_pack_v2(size):
+    frame = _random_frame(size)
+    return lambda: walle._pack_v2(frame, 0, 8)
+
+def bench_local_encode(size):
+    driver = walle.LocalLedDisplay(num_rows=size, num_cols=size, asynchronous=False,
+                                   spi=walle.FakeSpiDev())
+    frame = _random_frame(size)
+    return lambda: driver.set(frame)
+
+def bench_local_encode_uint8(size):
+    driver = walle.LocalLedDisplay(num_rows=size, num_cols=size, asynchronous=False,
+                                   spi=walle.FakeSpiDev())
+    frame = walle.frame_to_uint8(_random_frame(size))
+    return lambda: driver.set(frame)
+
+def bench_process_requests(size):
+    # one request per frame, sent from a local client socket. the datagram sizes need v2
+    # fragmentation past 10x10, so v1 is only used where it fits.
+    server = walle._UdpLedDisplayServer(('127.0.0.1', 0), walle.FakeDisplay(size, size))
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.connect(server._socket.getsockname())
+    client.setblocking(False)
+    frame = _random_frame(size)
+    datagrams = [walle._pack_udp(frame, 0)]
+    if len(datagrams[0]) > walle.DEFAULT_MAX_DATAGRAM_SIZE:
+        datagrams = walle._pack_v2(frame, 0, 8)
+
+    def run():
+        for datagram in datagrams:
+            client.send(datagram)
+        server._process_requests()
+        # drop the acks so they don't back up
+        while True:
+            try:
+                client.recv(walle._MAX_RECV_SIZE)
+            except BlockingIOError:
+                break
+    return run
+
+def _conway_step(engine, size):
+    # checks the engine against the original cell-by-cell step before timing it
+    grid = np.random.choice([False, True], (size, size))
+    game = conway_game_of_life.ENGINES[engine](size, size)
+    game.set_grid(grid)
+    for _ in range(3):
+        game.update()
+        grid = conway_game_of_life._reference_step(grid)
+        assert np.array_equal(game.get_grid(), grid), '{} engine disagrees'.format(engine)
+    return game.update
+
+def bench_conway_step(size):
+    return _conway_step('numpy', size)
+
+def bench_conway_step_packed(size):
+    return _conway_step('packed', size)
+
+def bench_conway_update(size):
+    driver = walle.FakeDisplay(size, size)
+    profilers = [walle.IntervalProfiler(name, walle.log) for name in ('update', 'monitor', 'cells')]
+    # a tiny step time steps the game on every update
+    display = ConwayGameOfLifeDisplay(driver, game_step_time=1e-6, fade_time=1e-6,
+                                      game_update_profiler=profilers[0],
+                                      game_monitor_profiler=profilers[1],
+                                      cell_update_profiler=profilers[2])
+    return display.update
+
+def bench_matrix_rain_update(size):
+    driver = walle.FakeDisplay(size, size)
+    return MatrixRain(size, size, driver).update
+
+def bench_splasher_update(size):
+    driver = walle.FakeDisplay(size, size)
+    return Splasher(driver, diffusion_half_life=0.2, avg_splash_rate=5, max_splash_area=1,
+                    min_splash_time=0., max_splash_time=0.5, target_avg_brightness=0.5).update
+
+BENCHMARKS = {
+    'pack_udp': bench_pack_udp,
+    'unpack_udp': bench_unpack_udp,
+    'pack_v2': bench_pack_v2,
+    'local_encode': bench_local_encode,
+    'local_encode_uint8': bench_local_encode_uint8,
+    'process_requests': bench_process_requests,
+    'conway_step': bench_conway_step,
+    'conway_step_packed': bench_conway_step_packed,
+    'conway_update': bench_conway_update,
+    'matrix_rain_update': bench_matrix_rain_update,
+    'splasher_update': bench_splasher_update,
+}
+
+def run_benchmark(fn, min_time, max_iterations, num_warmup=3):
+    """
+    calls fn until it has run for min_time seconds or max_iterations times (at least once after
+    warming up) and returns its latency summary
+    """
+    for _ in range(num_warmup):
+        fn()
+    times = []
+    t_end = time.perf_counter() + min_time
+    while len(times) < max_iterations:
+        t0 = time.perf_counter()
+        fn()
+        t1 = time.perf_counter()
+        times.append(t1 - t0)
+        if t1 >= t_end:
+            break
+    times = np.array(times)
+    result = {'num': len(times), 'mean': float(times.mean()), 'fps': float(1. / times.mean())}
+    for p, t in zip(PERCENTILES, np.percentile(times, PERCENTILES)):
+        result['p{}'.format(p)] = float(t)
+    return result
+
+def compare(results, baseline, threshold):
+    """
+    returns the names of the benchmarks whose median latency is more than threshold (a proportion)
+    worse than the baseline's. benchmarks missing from either side are ignored.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['p50'] / baseline[name]['p50']
+        if ratio > 1. + threshold:
+            regressions.append(name)
+            print('REGRESSION {}: p50 {:.3f} ms vs {:.3f} ms baseline ({:+.0%})'.format(
+                name, result['p50'] * 1e3, baseline[name]['p50'] * 1e3, ratio - 1.))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Square panel sizes to run at')
+    parser.add_argument('--filter', type=str, default=None,
+                        help='Only run benchmarks whose name matches this regex')
+    parser.add_argument('--min_time', type=float, default=1.,
+                        help='Seconds to run each benchmark for')
+    parser.add_argument('--max_iterations', type=int, default=1000,
+                        help='Most iterations to run each benchmark for')
+    parser.add_argument('--save', type=str, default=None, help='Save results to this JSON file')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Compare against results saved with --save')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Proportion the median latency may regress by before failing')
+    parser.add_argument('--verbose', action='store_true', default=False,
+                        help='Show walle logging on the console')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        walle._log_console_handler.setLevel(logging.WARNING)
+
+    results = {}
+    print('{:<32} {:>7} {:>10} {:>10} {:>10} {:>10}'.format('benchmark', 'num', 'p50 ms', 'p90 ms',
+                                                           'p99 ms', 'fps'))
+    for bench_name, bench in BENCHMARKS.items():
+        if args.filter and not re.search(args.filter, bench_name):
+            continue
+        for size in args.sizes:
+            name = '{}@{}x{}'.format(bench_name, size, size)
+            np.random.seed(0)
+            result = run_benchmark(bench(size), args.min_time, args.max_iterations)
+            results[name] = result
+            print('{:<32} {:>7} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.1f}'.format(
+                name, result['num'], result['p50'] * 1e3, result['p90'] * 1e3,
+                result['p99'] * 1e3, result['fps']))
+            sys.stdout.flush()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+        print('no regressions beyond {:.0%}'.format(args.threshold))
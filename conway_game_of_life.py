@@ -2,13 +2,41 @@
 
 import argparse
 import colour
-from grayfade import ColorFader
+import concurrent.futures
+import heapq
 import itertools
 import numpy as np
+import os
 import random
+import signal
+import threading
 import time
 import walle
 
+_NEIGHBOR_OFFSETS = [(x, y) for x, y in itertools.product((-1, 0, 1), (-1, 0, 1)) if x or y]
+assert len(_NEIGHBOR_OFFSETS) == 8
+
+def _reference_step(grid):
+    # the original cell-by-cell step, kept as the reference the vectorized engines are checked
+    # against (see benchmark.py)
+    num_rows, num_cols = grid.shape
+    new_grid = np.zeros(grid.shape, dtype=bool)
+    for row in range(num_rows):
+        for col in range(num_cols):
+            neighs_alive = sum([grid[(row + y) % num_rows][(col + x) % num_cols]
+                                for x, y in _NEIGHBOR_OFFSETS])
+            new_grid[row][col] = neighs_alive == 3 or neighs_alive == 2 and grid[row, col]
+    return new_grid
+
+def neighbor_counts(grid):
+    """
+    returns the number of live neighbors of every cell of the toroidal grid, as a uint8 array.
+    the 3x3 box sums are separable: sum each cell's column of three, then three of those sums.
+    """
+    cells = grid.astype(np.uint8)
+    cols = cells + np.roll(cells, 1, axis=0) + np.roll(cells, -1, axis=0)
+    return cols + np.roll(cols, 1, axis=1) + np.roll(cols, -1, axis=1) - cells
+
 class ConwayGameOfLife:
     def __init__(self, num_cols, num_rows):
         self._grid = np.zeros((num_rows, num_cols), dtype=bool)
@@ -16,14 +44,8 @@ class ConwayGameOfLife:
 
     def update(self):
         # advance the rules of life
-        new_grid = np.zeros(self._grid.shape, dtype=bool)
-        num_rows, num_cols = self._grid.shape
-        for row in range(num_rows):
-            for col in range(num_cols):
-                alive = self._grid[row, col]
-                neighs_alive = self.get_num_neighs_alive(row, col)
-                new_alive = neighs_alive == 3 or neighs_alive == 2 and alive
-                new_grid[row][col] = new_alive
+        neighs_alive = neighbor_counts(self._grid)
+        new_grid = (neighs_alive == 3) | (self._grid & (neighs_alive == 2))
 
         # detect stuck
         if np.array_equal(new_grid, self._grid):
@@ -41,65 +63,430 @@ class ConwayGameOfLife:
 
     def get_num_neighs_alive(self, row, col):
         num_rows, num_cols = self._grid.shape
-        offsets = [(x, y) for x, y in itertools.product((-1, 0, 1), (-1, 0, 1)) if x or y]
-        assert len(offsets) == 8
-        return sum([self._grid[(row + y) % num_rows][(col + x) % num_cols] for x, y in offsets])
+        return sum([self._grid[(row + y) % num_rows][(col + x) % num_cols]
+                    for x, y in _NEIGHBOR_OFFSETS])
+
+    def num_stuck_cycles(self):
+        return self._num_stuck_cycles
+
+class PackedConwayGameOfLife:
+    """
+    ConwayGameOfLife on a bit-packed grid: each row is stored as uint64 words, column c in bit
+    c % 64 of word c // 64, so every word operation steps 64 cells. the neighbor counts are added
+    up bitwise, with a bit plane per binary digit, and never materialized per cell.
+
+    columns past the end of the row (when it isn't a multiple of 64 long) are kept clear.
+    """
+    def __init__(self, num_cols, num_rows):
+        self._num_cols = num_cols
+        self._num_words = (num_cols + 63) // 64
+        self._last_bit = np.uint64((num_cols - 1) % 64)
+        self._last_word_mask = np.uint64(2**((num_cols - 1) % 64 + 1) - 1)
+        self._words = np.zeros((num_rows, self._num_words), dtype='<u8')
+        self._num_stuck_cycles = 0
+
+    def update(self):
+        words = self._words
+        one, top = np.uint64(1), np.uint64(63)
+        # west[c] = words[c - 1] and east[c] = words[c + 1], carrying bits across words. the
+        # carries into the first and last columns wrap around the row.
+        west = (words << one) | (np.roll(words, 1, axis=1) >> top)
+        east = (words >> one) | (np.roll(words, -1, axis=1) << top)
+        if self._num_cols % 64:
+            west[:, 0] |= (words[:, -1] >> self._last_bit) & one
+            east[:, -1] |= (words[:, 0] & one) << self._last_bit
+
+        # count the 8 neighbors into bit planes: ones, twos, and a sticky "four or more"
+        ones = np.zeros_like(words)
+        twos = np.zeros_like(words)
+        fours = np.zeros_like(words)
+        for plane in (west, east):
+            for neighbors in (plane, np.roll(plane, 1, axis=0), np.roll(plane, -1, axis=0)):
+                carry = ones & neighbors
+                ones ^= neighbors
+                fours |= twos & carry
+                twos ^= carry
+        for neighbors in (np.roll(words, 1, axis=0), np.roll(words, -1, axis=0)):
+            carry = ones & neighbors
+            ones ^= neighbors
+            fours |= twos & carry
+            twos ^= carry
+
+        # alive next with exactly 3 neighbors, or 2 and alive now
+        new_words = ~fours & twos & (ones | words)
+        new_words[:, -1] &= self._last_word_mask
+
+        # detect stuck
+        if np.array_equal(new_words, self._words):
+            self._num_stuck_cycles += 1
+
+        self._words = new_words
+
+    def get_grid(self):
+        cells = np.unpackbits(self._words.view(np.uint8), axis=1, bitorder='little')
+        return cells[:, :self._num_cols].astype(bool)
+
+    def set_grid(self, new_grid):
+        assert new_grid.shape == (self._words.shape[0], self._num_cols)
+        assert new_grid.dtype == bool
+        cells = np.zeros((new_grid.shape[0], 64 * self._num_words), dtype=bool)
+        cells[:, :self._num_cols] = new_grid
+        self._words = np.packbits(cells, axis=1, bitorder='little').view('<u8')
+
+    def get_num_neighs_alive(self, row, col):
+        grid = self.get_grid()
+        num_rows, num_cols = grid.shape
+        return sum([grid[(row + y) % num_rows][(col + x) % num_cols] for x, y in _NEIGHBOR_OFFSETS])
+
+    def num_stuck_cycles(self):
+        return self._num_stuck_cycles
+
+class _Node:
+    """
+    a 2^level x 2^level square of a HashLife universe. nodes are interned by
+    HashLifeConwayGameOfLife, so equal squares are the same node and results can be memoized on
+    them.
+    """
+    __slots__ = ('nw', 'ne', 'sw', 'se', 'level', 'population', 'successors', 'cells')
+
+    def __init__(self, nw, ne, sw, se, level, population):
+        self.nw, self.ne, self.sw, self.se = nw, ne, sw, se
+        self.level = level
+        self.population = population
+        self.successors = None # 2^j generations later -> center, memoized
+        self.cells = None # bool array, memoized for small nodes
+
+_DEAD = _Node(None, None, None, None, 0, 0)
+_ALIVE = _Node(None, None, None, None, 0, 1)
+
+class HashLifeConwayGameOfLife:
+    """
+    game of life on an unbounded plane, with Gosper's HashLife: the universe is a quadtree of
+    interned nodes, and the center of every node is memoized 2^j generations ahead. repetitive
+    patterns are mostly cache hits, so fast_forward() can jump 2^k generations in about the time
+    one generation takes, however long the pattern has been running.
+
+    get_grid() and set_grid() see a num_rows x num_cols viewport into the universe, whose top left
+    corner can be moved with set_viewport() or pan(). set_pattern() places grids of any size.
+
+    the node cache is bounded: once it holds more than max_nodes nodes, everything but the current
+    universe is evicted, memoized results included.
+    """
+    # nodes up to this level keep their cells as an array, so the viewport is drawn in blocks
+    BLOCK_LEVEL = 3
+
+    def __init__(self, num_cols, num_rows, max_nodes=500000):
+        self._dim = (num_rows, num_cols)
+        self._max_nodes = max_nodes
+        self._nodes = {}
+        self._empty = [_DEAD]
+        self._root = self._empty_node(3)
+        self._origin = (0, 0) # universe coordinates of the root's top left corner
+        self._viewport = (0, 0)
+        self._num_generations = 0
+        self._num_stuck_cycles = 0
+
+    def update(self):
+        self._advance(0)
+
+    def fast_forward(self, k):
+        # advances 2^k generations at once
+        assert k >= 0
+        self._advance(k)
+
+    def get_grid(self):
+        return self._region(self._viewport, self._dim)
+
+    def set_grid(self, new_grid):
+        assert new_grid.shape == self._dim
+        assert new_grid.dtype == bool
+        self.set_pattern(new_grid, *self._viewport)
+
+    def set_pattern(self, grid, row=0, col=0):
+        # replaces the universe with the grid, its top left corner at universe (row, col)
+        assert grid.dtype == bool
+        level = max(3, int(np.ceil(np.log2(max(grid.shape + (1,))))))
+        square = np.zeros((2**level, 2**level), dtype=bool)
+        square[:grid.shape[0], :grid.shape[1]] = grid
+        self._root = self._from_array(square)
+        self._origin = (row, col)
+        self._crop()
+
+    def viewport(self):
+        return self._viewport
+
+    def set_viewport(self, row, col):
+        self._viewport = (row, col)
+
+    def pan(self, num_rows, num_cols):
+        self._viewport = (self._viewport[0] + num_rows, self._viewport[1] + num_cols)
+
+    def num_generations(self):
+        return self._num_generations
+
+    def population(self):
+        return self._root.population
+
+    def num_nodes(self):
+        return len(self._nodes)
+
+    def get_num_neighs_alive(self, row, col):
+        cells = self._region((self._viewport[0] + row - 1, self._viewport[1] + col - 1), (3, 3))
+        return int(cells.sum()) - int(cells[1, 1])
 
     def num_stuck_cycles(self):
         return self._num_stuck_cycles
 
+    def _join(self, nw, ne, sw, se):
+        key = (nw, ne, sw, se)
+        node = self._nodes.get(key)
+        if node is None:
+            node = _Node(nw, ne, sw, se, nw.level + 1,
+                         nw.population + ne.population + sw.population + se.population)
+            self._nodes[key] = node
+        return node
+
+    def _empty_node(self, level):
+        while len(self._empty) <= level:
+            e = self._empty[-1]
+            self._empty.append(self._join(e, e, e, e))
+        return self._empty[level]
+
+    def _from_array(self, square):
+        level = int(np.log2(square.shape[0]))
+        if level == 0:
+            return _ALIVE if square[0, 0] else _DEAD
+        if not square.any():
+            return self._empty_node(level)
+        half = square.shape[0] // 2
+        return self._join(self._from_array(square[:half, :half]),
+                          self._from_array(square[:half, half:]),
+                          self._from_array(square[half:, :half]),
+                          self._from_array(square[half:, half:]))
+
+    def _centered(self, node):
+        # the node in the middle of an otherwise empty node twice its size
+        e = self._empty_node(node.level - 1)
+        return self._join(self._join(e, e, e, node.nw), self._join(e, e, node.ne, e),
+                          self._join(e, node.sw, e, e), self._join(node.se, e, e, e))
+
+    def _center(self, node):
+        return self._join(node.nw.se, node.ne.sw, node.sw.ne, node.se.nw)
+
+    def _advance(self, j):
+        if len(self._nodes) > self._max_nodes:
+            self._evict()
+        root, (row, col) = self._root, self._origin
+
+        # pad the root so it is at least level j + 1, then center it twice. the successor is the
+        # middle half of that, which leaves room for the pattern to grow by 2^j (the speed of
+        # light) on every side.
+        while root.level < j + 1:
+            row, col = row - 2**(root.level - 1), col - 2**(root.level - 1)
+            root = self._centered(root)
+        for _ in range(2):
+            row, col = row - 2**(root.level - 1), col - 2**(root.level - 1)
+            root = self._centered(root)
+        row, col = row + 2**(root.level - 2), col + 2**(root.level - 2)
+        previous = (self._root, self._origin)
+        self._root, self._origin = self._successor(root, j), (row, col)
+        self._crop()
+        self._num_generations += 2**j
+
+        # detect stuck
+        if (self._root, self._origin) == previous:
+            self._num_stuck_cycles += 1
+
+    def _crop(self):
+        # drops empty borders, so the root stays as small as the pattern allows
+        while self._root.level > 3 and self._center(self._root).population == \
+              self._root.population:
+            offset = 2**(self._root.level - 2)
+            self._root = self._center(self._root)
+            self._origin = (self._origin[0] + offset, self._origin[1] + offset)
+
+    def _successor(self, node, j):
+        """
+        returns the center of the node (half its size) 2^j generations later, where 2^j is at most
+        a quarter of the node's size. the center only depends on cells within 2^j of it, which are
+        all in the node.
+        """
+        if node.population == 0:
+            return node.nw
+        j = min(j, node.level - 2)
+        if node.successors is None:
+            node.successors = {}
+        result = node.successors.get(j)
+        if result is not None:
+            return result
+        if node.level == 2:
+            result = self._step_4x4(node)
+        else:
+            nw, ne, sw, se = node.nw, node.ne, node.sw, node.se
+            # the nine overlapping half-size squares, each advanced by up to 2^(level - 3)
+            # generations
+            sub_j = min(j, node.level - 3)
+            c = [self._successor(self._join(*q), sub_j) for q in (
+                    (nw.nw, nw.ne, nw.sw, nw.se), (nw.ne, ne.nw, nw.se, ne.sw),
+                    (ne.nw, ne.ne, ne.sw, ne.se), (nw.sw, nw.se, sw.nw, sw.ne),
+                    (nw.se, ne.sw, sw.ne, se.nw), (ne.sw, ne.se, se.nw, se.ne),
+                    (sw.nw, sw.ne, sw.sw, sw.se), (sw.ne, se.nw, sw.se, se.sw),
+                    (se.nw, se.ne, se.sw, se.se))]
+            quads = ((c[0], c[1], c[3], c[4]), (c[1], c[2], c[4], c[5]),
+                     (c[3], c[4], c[6], c[7]), (c[4], c[5], c[7], c[8]))
+            if j < node.level - 2:
+                # those were already advanced far enough: take the centers of the four quadrants
+                result = self._join(*(self._center(self._join(*q)) for q in quads))
+            else:
+                # advance the four quadrants by the other half
+                result = self._join(*(self._successor(self._join(*q), sub_j) for q in quads))
+        node.successors[j] = result
+        return result
+
+    def _step_4x4(self, node):
+        # one generation of the middle 2x2 of a 4x4 node, by brute force
+        cells = self._cells(node)
+        center = np.zeros((2, 2), dtype=bool)
+        for row in range(2):
+            for col in range(2):
+                box = cells[row:row + 3, col:col + 3]
+                neighs_alive = int(box.sum()) - int(box[1, 1])
+                center[row, col] = neighs_alive == 3 or neighs_alive == 2 and box[1, 1]
+        return self._join(*(_ALIVE if alive else _DEAD for alive in center.flat))
+
+    def _cells(self, node):
+        if node.cells is None:
+            if node.level == 0:
+                node.cells = np.array([[node.population == 1]])
+            else:
+                node.cells = np.block([[self._cells(node.nw), self._cells(node.ne)],
+                                       [self._cells(node.sw), self._cells(node.se)]])
+        return node.cells
+
+    def _region(self, top_left, dim):
+        # the cells of the universe in a dim-sized rectangle
+        out = np.zeros(dim, dtype=bool)
+        self._paint(self._root, self._origin, out, top_left)
+        return out
+
+    def _paint(self, node, corner, out, top_left):
+        size = 2**node.level
+        row0, col0 = corner[0] - top_left[0], corner[1] - top_left[1]
+        if node.population == 0 or row0 >= out.shape[0] or col0 >= out.shape[1] or \
+           row0 + size <= 0 or col0 + size <= 0:
+            return
+        if node.level <= self.BLOCK_LEVEL:
+            cells = self._cells(node)
+            r0, c0 = max(row0, 0), max(col0, 0)
+            r1, c1 = min(row0 + size, out.shape[0]), min(col0 + size, out.shape[1])
+            out[r0:r1, c0:c1] = cells[r0 - row0:r1 - row0, c0 - col0:c1 - col0]
+            return
+        half = size // 2
+        self._paint(node.nw, corner, out, top_left)
+        self._paint(node.ne, (corner[0], corner[1] + half), out, top_left)
+        self._paint(node.sw, (corner[0] + half, corner[1]), out, top_left)
+        self._paint(node.se, (corner[0] + half, corner[1] + half), out, top_left)
+
+    def _evict(self):
+        # starts the node cache over with just the current universe's nodes
+        walle.log.info('evicting {} hashlife nodes'.format(len(self._nodes)))
+        self._nodes = {}
+        self._empty = [_DEAD]
+        interned = {}
+        def intern(node):
+            if node.level == 0:
+                return node
+            result = interned.get(id(node))
+            if result is None:
+                result = self._join(intern(node.nw), intern(node.ne), intern(node.sw),
+                                    intern(node.se))
+                interned[id(node)] = result
+            return result
+        self._root = intern(self._root)
+
+# the game engines, by name. they all take (num_cols, num_rows) and share get_grid()/set_grid()
+ENGINES = {
+    'numpy': ConwayGameOfLife,
+    'packed': PackedConwayGameOfLife,
+    'hashlife': HashLifeConwayGameOfLife,
+}
+
+def _min_rotations(seq):
+    # returns the shifts k for which np.roll(seq, -k) is the lexicographically smallest rotation
+    # of the 1D sequence
+    n = len(seq)
+    rotations = seq.astype('>u2')[(np.arange(n)[:, None] + np.arange(n)) % n]
+    # big-endian rows viewed as byte strings sort lexicographically, like the sequences
+    keys = rotations.view('S{}'.format(2 * n)).ravel()
+    return np.flatnonzero(keys == np.sort(keys)[0])
+
+def canonical_torus(grid, max_candidates=16):
+    """
+    returns the game state as bytes that are the same for every translation of the toroidal grid,
+    so states that only differ by where they sit on the torus (e.g. a glider, generations apart)
+    compare equal.
+
+    the grid is rolled so its sequences of row and column populations, which are themselves only
+    rotated by a translation, start at their smallest rotation. populations that repeat along the
+    torus leave several equally good shifts, and the one giving the smallest bytes is used. the
+    bytes are always of a translation of the grid, so distinct states never compare equal. if there
+    are more than max_candidates such shifts only the first ones are tried, so a translated state
+    can then be missed, but only for very regular grids.
+    """
+    row_shifts = _min_rotations(grid.sum(axis=1))
+    col_shifts = _min_rotations(grid.sum(axis=0))
+    candidates = list(itertools.islice(itertools.product(row_shifts, col_shifts), max_candidates))
+    return min(np.packbits(np.roll(grid, (-row, -col), axis=(0, 1))).tobytes()
+               for row, col in candidates)
+
 class ConwayGameOfLifeMonitor:
-    def __init__(self, game, max_cycling_game_generations):
+    def __init__(self, game, max_cycling_game_generations, max_history=1000):
         self._game = game
+        # canonical state -> generation it was seen at, for the most recent max_history
+        # generations. dicts keep insertion order, so the oldest entry is the first.
         self._generations = {}
+        self._max_history = max_history
         self._max_cycling_game_generations = max_cycling_game_generations
+        # Brent's algorithm checkpoint: one (state, generation) that moves to the current state
+        # after 1, 2, 4, ... generations. it catches cycles longer than the history, within a few
+        # periods of the game entering them.
+        self._checkpoint = (None, 0)
+        self._checkpoint_interval = 1
         self._num_generations = 0
         self._generations_to_go = None
+        self._cycle = None
 
     def update(self):
-        # The grid is an arbitrary 2D view of the toroidal game, so we should treat game states as
-        # invariant under translations and rotations. Obtain all 4 possible 2D rotations of the
-        # game, and "center" each one by justifying its upper-most, left-most set pixel (upper-most
-        # is prioritized) to the upper-left corner. There's probably a clever way to choose a
-        # consistent rotation for a game state versus just computing all 4, but we don't do that :).
-        #
-        # Note that centering/rotating the game isn't required to detect cycles--a cyclical game
-        # will always eventually revisit the original position and rotation. Centering/rotating the
-        # game just allows cycles to be detected earlier, which makes the game less boring.
-        #
-        # NOTE: This does not cover invariance to reflections....
+        # The grid is an arbitrary 2D view of the toroidal game, so game states are compared in a
+        # form that is invariant under translation. Translation isn't required to detect cycles--a
+        # cyclical game will always eventually revisit the original position. It just allows cycles
+        # like gliders to be detected before they wrap all the way around, which makes the game
+        # less boring.
         #
-        # NOTE: Actually, just doing 1 rotation for now... it was getting slow.
-        #
-        # NOTE: Actually not doing the centering now, either. Problem is 1) it didn't successfuly
-        # detect a simple glider, so there's a big somewhere; 2) it doesn't work anyway--aligning
-        # the top-left set pixel is still ambiguous! So until I figure out an actual way to compare
-        # two toruses, I'm just going to compare the grids directly.
-        #grids = self._centered_rotated_grids(self._game.get_grid(), num_rots=1)
-        grids = [self._game.get_grid()]
-        assert len(grids) == 1
-
-        # Condense each of the grids into single-integer bitmasks. This presumably makes storing
-        # these values in a historical dict cheaper than, say, storing ndarray.data.tobytes().
-        bitmasks = [self._grid_to_int(grid) for grid in grids]
-
-        # Now see if any of these bitmasks are in the generation history. Only one should appear,
-        # since if there was more than one that would mean a duplicate was added earlier. Only do
-        # this if we haven't already decided to stop the game, though.
+        # NOTE: This does not cover invariance to rotations or reflections....
+        state = canonical_torus(self._game.get_grid())
+
+        # See if the state is in the generation history, or is the checkpoint. Only do this if we
+        # haven't already decided to stop the game, though. The history catches short cycles on
+        # their first repeat; the checkpoint catches the ones that are longer than the history.
         if self._generations_to_go is None:
-            try:
-                past = next(past for past in (self._generations.get(b, None) for b in bitmasks)
-                                if past is not None)
+            past = self._generations.get(state, None)
+            if past is None and state == self._checkpoint[0]:
+                past = self._checkpoint[1]
+            if past is not None:
                 period = self._num_generations - past
+                self._cycle = (self._num_generations, period)
                 self._generations_to_go = min(5 * period, self._max_cycling_game_generations)
                 walle.log.info('At {} generations, detected game cycle of {} generations! Stopping '
                                'after {} more generations'.format(self._num_generations,
                                     period, self._generations_to_go))
-            except StopIteration:
-                # Bitmask has not been seen before; store this generation along with the current
-                # generation index. Arbitrarily store the first "version" of this generation.
-                # There's no point storing all the rotations, etc.
-                self._generations[bitmasks[0]] = self._num_generations
+            else:
+                self._generations[state] = self._num_generations
+                if len(self._generations) > self._max_history:
+                    del self._generations[next(iter(self._generations))]
+                if self._num_generations - self._checkpoint[1] >= self._checkpoint_interval:
+                    self._checkpoint = (state, self._num_generations)
+                    self._checkpoint_interval *= 2
 
         # Incrementing this first means game-stop printout below will "count" this generation.
         self._num_generations += 1
@@ -112,87 +499,167 @@ class ConwayGameOfLifeMonitor:
     def is_game_done(self):
         return self._generations_to_go == 0
 
-    def _grid_to_int(self, grid):
-        assert grid.dtype == bool
-        assert grid.shape == (10, 10)
-        bitmask = 0
-        for cell in grid.flatten():
-            bitmask = (bitmask << 1) | (1 if cell else 0)
-        return bitmask
-
-    def _center_grid(self, grid):
-        # Find the first occupied row, if any. If the game is blank, select the first row.
-        try:
-            first_row = next(i for i, row in enumerate(grid) if np.sum(row))
-        except StopIteration:
-            first_row = 0
-
-        # Find the first occupied column in the first occupied row, if any. If the game is blank,
-        # select the first column.
-        try:
-            first_col = next(i for i, col in enumerate(grid[first_row]) if col)
-        except StopIteration:
-            first_col = 0
-
-        # Now rotate the grid so that the cell identified by the first row and column is upper-left
-        # justified.
-        return np.roll(np.roll(grid, -first_row, axis=0), -first_col, axis=1)
-
-    def _centered_rotated_grids(self, grid, num_rots=4):
-        assert 0 <= num_rots <= 4
-        if num_rots == 0:
-            return []
-        else:
-            return [grid] + self._centered_rotated_grids(np.rot90(grid), num_rots - 1)
+    def detected_cycle(self):
+        # (generation the cycle was detected at, its period), or None if none was detected yet
+        return self._cycle
+
+def _init_screening_worker():
+    # screening is background work: stay out of the render loop's way, and leave ctrl-c and the
+    # per-game logging to the main process
+    os.nice(10)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    walle.log.setLevel('WARNING')
+
+def _screen_seed(dim, engine, seed, max_generations):
+    """
+    plays the game from a random grid made from the seed until the monitor detects a cycle or
+    max_generations pass. returns the grid with its lifespan (generations until the cycle was
+    detected, or max_generations), the cycle's period (0 if none) and its activity (the average
+    proportion of cells changing per generation).
+    """
+    grid = np.random.default_rng(seed).choice([False, True], dim)
+    game = ENGINES[engine](dim[1], dim[0])
+    game.set_grid(grid)
+    monitor = ConwayGameOfLifeMonitor(game, max_generations)
+    last_grid = grid
+    num_changes = 0
+    for num_generations in range(1, max_generations + 1):
+        monitor.update()
+        if monitor.detected_cycle() is not None:
+            break
+        game.update()
+        new_grid = game.get_grid()
+        num_changes += np.count_nonzero(new_grid != last_grid)
+        last_grid = new_grid
+    cycle = monitor.detected_cycle()
+    lifespan, period = cycle if cycle is not None else (max_generations, 0)
+    return grid, lifespan, period, num_changes / (max(lifespan, 1) * grid.size)
+
+class SeedScreener:
+    """
+    keeps a queue of starting grids that make for interesting games. a pool of background processes
+    plays random grids headlessly, at full speed, and scores them on how long they play before
+    settling into a cycle (or rather, before the monitor detects one), the cycle's period and their
+    activity. grids are accepted if the game would last at least min_generations (counting the
+    5 periods the display keeps playing a cycle for) and at least min_activity of the cells change
+    per generation on average.
+
+    screening stops while queue_size grids are waiting. get() never blocks: it returns the best
+    waiting grid, or None if there isn't one yet.
+    """
+    def __init__(self, dim, engine='numpy', num_workers=None, queue_size=8, min_generations=200,
+                 min_activity=0.02, max_generations=5000):
+        self._dim = tuple(dim)
+        self._engine = engine
+        self._num_workers = num_workers or max((os.cpu_count() or 1) - 1, 1)
+        self._queue_size = queue_size
+        self._min_generations = min_generations
+        self._min_activity = min_activity
+        self._max_generations = max_generations
+        self._accepted = [] # heap of (-score, order, grid)
+        self._num_screened = 0
+        self._num_accepted = 0
+        self._num_pending = 0
+        self._closed = False
+        # the pool's callbacks run on its own thread
+        self._lock = threading.RLock()
+        self._seeds = itertools.count(random.getrandbits(32) << 32)
+        self._pool = concurrent.futures.ProcessPoolExecutor(self._num_workers,
+                                                            initializer=_init_screening_worker)
+        walle.log.info('screening seeds for {}x{} games in {} processes'.format(
+                *reversed(self._dim), self._num_workers))
+        self._submit()
+
+    def get(self):
+        with self._lock:
+            grid = heapq.heappop(self._accepted)[2] if self._accepted else None
+        self._submit()
+        return grid
+
+    def num_screened(self):
+        return self._num_screened
+
+    def num_accepted(self):
+        return self._num_accepted
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self._pool.shutdown(cancel_futures=True)
+
+    def _submit(self):
+        # two seeds in flight per worker keeps them busy, until the queue is full
+        with self._lock:
+            while not self._closed and len(self._accepted) < self._queue_size and \
+                  self._num_pending < 2 * self._num_workers:
+                try:
+                    future = self._pool.submit(_screen_seed, self._dim, self._engine,
+                                               next(self._seeds), self._max_generations)
+                except RuntimeError:
+                    # the pool was shut down without close(), e.g. by the interpreter exiting
+                    self._closed = True
+                    return
+                self._num_pending += 1
+                future.add_done_callback(self._on_screened)
+
+    def _on_screened(self, future):
+        # runs on the pool's management thread as each seed is screened
+        with self._lock:
+            self._num_pending -= 1
+            if self._closed or future.cancelled():
+                return
+            if future.exception() is not None:
+                walle.log.warning('seed screening failed: {}'.format(future.exception()))
+                return
+            grid, lifespan, period, activity = future.result()
+            self._num_screened += 1
+            num_generations = lifespan + 5 * period
+            if num_generations >= self._min_generations and activity >= self._min_activity:
+                self._num_accepted += 1
+                score = num_generations * activity
+                heapq.heappush(self._accepted, (-score, self._num_accepted, grid))
+                walle.log.debug('accepted seed: lifespan {}, period {}, activity {:.3f}'.format(
+                        lifespan, period, activity))
+        self._submit()
 
 class ConwayGameOfLifeDisplay:
-    class Cell:
-        def __init__(self, fade_time, row, col):
-            self._fade_time = fade_time
-            self._row = row
-            self._col = col
-            self._num_generations = None
-            self._alive = None
-            self._last_alive = None
-            self._color_fader = ColorFader((0., 0., 0.), (0., 0., 0.), 0)
-
-        def update(self, now, alive, num_neighs_alive, num_generations):
-            if num_generations != self._num_generations:
-                self._num_generations = num_generations
-                self._last_alive = self._alive
-                self._alive = alive
-                new_color = self._get_color(num_neighs_alive)
-                if new_color != self._color_fader.get_color_range()[1]:
-                    self._color_fader.set(new_color, self._fade_time)
-            return self._color_fader.get(now)
-
-        def _get_color(self, num_neighs_alive):
-            red = (1., 0., 0.)
-            green = (0., 1., 0.)
-            blue = (0., 0., 1.)
-            gray = (0.5, 0.5, 0.5)
-            black = (0., 0., 0.)
-            if self._alive:
-                if 0 <= num_neighs_alive < 2:
-                    return red
-                elif 2 <= num_neighs_alive < 4:
-                    return gray if self._last_alive else blue
-                else:
-                    return red
-            else:
-                return black
+    # cell colors, indexed by the COLOR_* values
+    PALETTE = np.array([(0., 0., 0.), (1., 0., 0.), (0.5, 0.5, 0.5), (0., 0., 1.)],
+                       dtype=np.float32)
+    COLOR_DEAD, COLOR_LONELY_OR_CROWDED, COLOR_SURVIVED, COLOR_BORN = range(4)
 
     def __init__(self, driver, game_step_time, fade_time, game_update_profiler,
-                 game_monitor_profiler, cell_update_profiler):
+                 game_monitor_profiler, cell_update_profiler, engine='numpy', fast_forward_log2=0,
+                 pan_rate=(0., 0.), grid=None):
+        """
+        the game starts from grid (e.g. from a SeedScreener), or a random grid by default.
+
+        each game step advances 2^fast_forward_log2 generations, and moves the viewport by pan_rate
+        (rows, cols) cells. both need an engine with an unbounded universe, like 'hashlife'.
+        """
+        assert fast_forward_log2 >= 0
         self._driver = driver
         self._game_step_time = game_step_time
         num_rows, num_cols = driver.dim()
         dim = driver.dim()
-        self._game = ConwayGameOfLife(num_rows, num_cols)
-        self._game.set_grid(np.random.choice([False, True], dim))
-        self._cells = [[ConwayGameOfLifeDisplay.Cell(fade_time, row, col)
-                            for col in range(num_cols)] for row in range(num_rows)]
+        self._game = ENGINES[engine](num_cols, num_rows)
+        assert hasattr(self._game, 'fast_forward') or not (fast_forward_log2 or any(pan_rate))
+        self._fast_forward_log2 = fast_forward_log2
+        self._pan_rate = pan_rate
+        self._pan = (0., 0.) # fractional cells panned but not yet moved
+        if grid is None:
+            grid = np.random.choice([False, True], dim)
+        self._game.set_grid(grid)
         self._num_generations = 0
+
+        # every cell fades from its color when its generation began to the generation's color.
+        # fades are only restarted for cells whose color changes.
+        self._fade_time = fade_time
+        self._colored_generation = None
+        self._alive = np.zeros(dim, dtype=bool)
+        self._fade_from = np.zeros(dim + (3,), dtype=np.float32)
+        self._fade_to = np.zeros(dim + (3,), dtype=np.float32)
+        self._fade_start = np.zeros(dim)
         self._last_step = None
         self._game_update_profiler = game_update_profiler
         self._game_monitor_profiler = game_monitor_profiler
@@ -204,16 +671,21 @@ class ConwayGameOfLifeDisplay:
     def update(self):
         now = time.time()
 
-        grid = self._game.get_grid()
         with self._cell_update_profiler.measure():
-            matrix = [[cell.update(now, grid[row][col], self._game.get_num_neighs_alive(row, col),
-                                   self._num_generations)
-                        for col, cell in enumerate(cells)] for row, cells in enumerate(self._cells)]
+            if self._colored_generation != self._num_generations:
+                self._colored_generation = self._num_generations
+                self._color_generation(now)
+            matrix = self._colors(now)
         self._driver.set(matrix)
 
         if self._last_step is None or now - self._last_step >= self._game_step_time:
             with self._game_update_profiler.measure():
-                self._game.update()
+                if self._fast_forward_log2:
+                    self._game.fast_forward(self._fast_forward_log2)
+                else:
+                    self._game.update()
+                if any(self._pan_rate):
+                    self._step_pan()
             with self._game_monitor_profiler.measure():
                 self._game_monitor.update()
             self._last_step = now
@@ -222,11 +694,52 @@ class ConwayGameOfLifeDisplay:
     def is_done(self):
         return self._game_monitor.is_game_done()
 
+    def _step_pan(self):
+        pan = [p + rate for p, rate in zip(self._pan, self._pan_rate)]
+        move = [int(p) for p in pan]
+        self._game.pan(*move)
+        self._pan = tuple(p - m for p, m in zip(pan, move))
+
+    def _color_generation(self, now):
+        # live cells are red if they are about to die of loneliness or crowding, otherwise gray if
+        # they survived from the last generation or blue if they were just born
+        last_alive = self._alive
+        self._alive = self._game.get_grid()
+        neighs_alive = neighbor_counts(self._alive)
+        survives = (neighs_alive == 2) | (neighs_alive == 3)
+        colors = np.where(survives,
+                          np.where(last_alive, self.COLOR_SURVIVED, self.COLOR_BORN),
+                          self.COLOR_LONELY_OR_CROWDED)
+        colors[~self._alive] = self.COLOR_DEAD
+        new_colors = self.PALETTE[colors]
+
+        changed = (new_colors != self._fade_to).any(axis=2)
+        self._fade_from[changed] = self._colors(now)[changed]
+        self._fade_to[changed] = new_colors[changed]
+        self._fade_start[changed] = now
+
+    def _colors(self, now):
+        # all the fades, interpolated at once
+        if self._fade_time > 0:
+            progress = np.clip((now - self._fade_start) / self._fade_time, 0., 1.)
+        else:
+            progress = np.ones(self._fade_start.shape)
+        progress = progress[:, :, np.newaxis].astype(np.float32)
+        return self._fade_from + (self._fade_to - self._fade_from) * progress
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('target', type=str, help='The display to connect to')
     parser.add_argument('--game_step_time', type=float, default=0.3, help='Game of life step time')
     parser.add_argument('--fade_time_prop', type=float, default=1.2, help='Fade time proportion')
+    parser.add_argument('--engine', type=str, choices=sorted(ENGINES), default='numpy',
+                        help='Game of life engine')
+    parser.add_argument('--fast_forward_log2', type=int, default=0,
+                        help='Advance 2^this generations per game step (hashlife engine)')
+    parser.add_argument('--pan', type=float, nargs=2, default=(0., 0.), metavar=('ROWS', 'COLS'),
+                        help='Cells to pan the viewport by per game step (hashlife engine)')
+    parser.add_argument('--screen_workers', type=int, default=None,
+                        help='Processes pre-screening seeds for interesting games (0 to disable)')
     args = parser.parse_args()
 
     assert args.game_step_time > 0
@@ -242,16 +755,34 @@ if __name__ == '__main__':
     game_monitor_profiler = walle.IntervalProfiler('game monitor', walle.log, period=100)
     cell_update_profiler = walle.IntervalProfiler('cells display update', walle.log)
 
-    while True:
-        if game_of_life is None or game_of_life.is_done():
-            walle.log.info('New game!')
-            game_of_life = ConwayGameOfLifeDisplay(driver,
-                                                   fade_time=fade_time,
-                                                   game_step_time=args.game_step_time,
-                                                   game_update_profiler=game_update_profiler,
-                                                   game_monitor_profiler=game_monitor_profiler,
-                                                   cell_update_profiler=cell_update_profiler)
-
-        game_of_life.update()
-        profiler.mark()
-        period.sleep()
+    screener = None
+    if args.screen_workers != 0:
+        screener = SeedScreener(driver.dim(), engine=args.engine, num_workers=args.screen_workers)
+
+    try:
+        while True:
+            if game_of_life is None or game_of_life.is_done():
+                grid = screener.get() if screener is not None else None
+                if screener is not None:
+                    walle.log.info('New game! ({} of {} screened seeds accepted{})'.format(
+                            screener.num_accepted(), screener.num_screened(),
+                            '' if grid is not None else ', none ready yet'))
+                else:
+                    walle.log.info('New game!')
+                game_of_life = ConwayGameOfLifeDisplay(driver,
+                                                       fade_time=fade_time,
+                                                       game_step_time=args.game_step_time,
+                                                       game_update_profiler=game_update_profiler,
+                                                       game_monitor_profiler=game_monitor_profiler,
+                                                       cell_update_profiler=cell_update_profiler,
+                                                       engine=args.engine,
+                                                       fast_forward_log2=args.fast_forward_log2,
+                                                       pan_rate=tuple(args.pan),
+                                                       grid=grid)
+
+            game_of_life.update()
+            profiler.mark()
+            period.sleep()
+    finally:
+        if screener is not None:
+            screener.close()
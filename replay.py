@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+import argparse
+import walle
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recording', type=str,
+                        help='Recording to play, e.g. made with a record:path:target target')
+    parser.add_argument('target', type=str, help='The display to connect to')
+    parser.add_argument('--rate', type=float, default=1., help='Playback speed multiplier')
+    parser.add_argument('--loop', action='store_true', default=False, help='Play forever')
+    args = parser.parse_args()
+
+    assert args.rate > 0
+
+    recording = walle.FrameRecording(args.recording)
+    walle.log.info('playing {} {}x{} frames ({:.1f} s)'.format(
+            len(recording), *reversed(recording.dim()),
+            recording.time(len(recording) - 1) if len(recording) else 0.))
+    driver = walle.create_display(args.target)
+    recording.play(driver, rate=args.rate, loop=args.loop)
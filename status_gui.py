@@ -23,7 +23,7 @@ class StatusDisplay:
 
             # update the display if a new matrix is available
             matrix = self._driver.get()
-            if matrix:
+            if matrix is not None:
                 self._display_matrix(matrix)
 
             period.sleep()
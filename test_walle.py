@@ -0,0 +1,54 @@
+import numpy as np
+import socket
+import threading
+import time
+import walle
+
+class _SlowAckServer:
+    """
+    a display server on loopback that waits ack_delay seconds before handling each complete request
+    """
+    def __init__(self, dim, ack_delay):
+        self.handler = walle._DisplayRequestHandler(walle.FakeDisplay(*dim))
+        self._ack_delay = ack_delay
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.settimeout(0.1)
+        self._stopped = False
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def port(self):
+        return self._socket.getsockname()[1]
+
+    def stop(self):
+        self._stopped = True
+        self._thread.join()
+        self._socket.close()
+
+    def _serve(self):
+        while not self._stopped:
+            try:
+                data, addr = self._socket.recvfrom(walle._MAX_RECV_SIZE)
+            except socket.timeout:
+                continue
+            request = self.handler.parse(data, addr, self._socket.sendto)
+            if request is not None:
+                time.sleep(self._ack_delay)
+                self.handler.process([request])
+
+def test_set_many_waits_for_slow_clip_part_acks():
+    # each part's ack takes several times the initial RTO, and longer than all of a single frame's
+    # retries put together
+    dim = (64, 64)
+    server = _SlowAckServer(dim, ack_delay=0.5)
+    try:
+        display = walle.UdpLedDisplay('127.0.0.1', server.port(), *dim, timeout=0.05,
+                                      max_timeout=1., max_retries=2)
+        frames = np.random.default_rng(0).integers(0, 256, (10, *dim, 3), dtype=np.uint8)
+        clip_id = display.set_many(list(frames), 0.01)
+        assert clip_id is not None
+        clip = server.handler._clips[clip_id]
+        assert np.array_equal(np.asarray(clip.frames), frames)
+    finally:
+        server.stop()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""
+load generator and soak tester for the UDP display server. by default it runs a
+_UdpLedDisplayServer with a FakeDisplay in a separate process on loopback, e.g.:
+
+    ./udp_load.py --writers 4 --write_hz 60 --pollers 8 --poll_hz 2 --rows 32 --cols 32
+
+or, with --host, drives a real server (which then can't report its side). writers are
+UdpLedDisplay clients calling set() at a fixed rate, pollers are clients calling get(). loss drops
+that proportion of the datagrams sent by the clients and (for the local server) of the acks.
+
+at the end it reports the ack latencies seen by the writers and pollers, the server's actuation
+rate, skipped and missing updates, how often its drain loop hit its per-wakeup cap, and its CPU use.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import numpy as np
+import random
+import resource
+import select
+import threading
+import time
+import walle
+
+PERCENTILES = (0.5, 0.9, 0.99, 0.999)
+
+class _LossySocket:
+    """
+    wraps a socket so sendto() silently drops the given proportion of datagrams
+    """
+    def __init__(self, sock, loss):
+        self._socket = sock
+        self._loss = loss
+
+    def sendto(self, data, addr):
+        if random.random() < self._loss:
+            return len(data)
+        return self._socket.sendto(data, addr)
+
+    def __getattr__(self, name):
+        return getattr(self._socket, name)
+
+def _serve(conn, num_rows, num_cols, loss):
+    # runs in the server process: report the port, serve until told to stop, then report the
+    # server's counts and CPU time
+    walle._log_console_handler.setLevel(logging.WARNING)
+    server = walle._UdpLedDisplayServer(('127.0.0.1', 0), walle.FakeDisplay(num_rows, num_cols))
+    if loss:
+        server._socket = _LossySocket(server._socket, loss)
+    conn.send(server._socket.getsockname()[1])
+    usage0 = resource.getrusage(resource.RUSAGE_SELF)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn.recv()
+    usage1 = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (usage1.ru_utime - usage0.ru_utime) + (usage1.ru_stime - usage0.ru_stime)
+    conn.send((server.counts(), cpu))
+
+def _write(driver, frames, rate, deadline, results):
+    num_sets = 0
+    next_set = time.perf_counter()
+    while next_set < deadline:
+        driver.set(frames[num_sets % len(frames)])
+        num_sets += 1
+        if rate:
+            # windowed clients only drain acks when asked, so keep draining until the next set()
+            # for the RTTs to be accurate
+            next_set += 1. / rate
+            while True:
+                time_left = next_set - time.perf_counter()
+                if time_left <= 0:
+                    break
+                select.select([driver.socket], [], [], time_left)
+                driver.window_full()
+        else:
+            next_set = time.perf_counter()
+    driver.window_full() # collect whatever acks are in by now
+    results.append((num_sets, driver.num_lost(), driver.num_timeouts(), driver.rtt_stats()))
+
+def _poll(driver, rate, deadline, results):
+    floor = walle.PeriodFloor(1. / rate) if rate else None
+    latencies = []
+    num_failed = 0
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        if driver.get() is None:
+            num_failed += 1
+        else:
+            latencies.append(time.perf_counter() - t0)
+        if floor is not None:
+            floor.sleep()
+    results.append((latencies, num_failed))
+
+def _format_ms(values):
+    if values is None:
+        return 'n/a'
+    return ' '.join('p{:g}={:.2f}ms'.format(100 * q, 1e3 * v) for q, v in zip(PERCENTILES, values))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default=None,
+                        help='Server to target, instead of running one on loopback')
+    parser.add_argument('--port', type=int, default=walle.DEFAULT_UDP_SERVER_PORT,
+                        help='Server port, with --host')
+    parser.add_argument('--rows', type=int, default=walle.DEFAULT_NUM_ROWS, help='Frame rows')
+    parser.add_argument('--cols', type=int, default=walle.DEFAULT_NUM_COLS, help='Frame columns')
+    parser.add_argument('--writers', type=int, default=1, help='Number of set() clients')
+    parser.add_argument('--write_hz', type=float, default=30.,
+                        help='set() rate per writer, or 0 for as fast as possible')
+    parser.add_argument('--pollers', type=int, default=0, help='Number of get() clients')
+    parser.add_argument('--poll_hz', type=float, default=1.,
+                        help='get() rate per poller, or 0 for as fast as possible')
+    parser.add_argument('--duration', type=float, default=10., help='Seconds to run for')
+    parser.add_argument('--loss', type=float, default=0., help='Proportion of datagrams to drop')
+    parser.add_argument('--protocol', type=int, default=walle.DEFAULT_PROTOCOL,
+                        help='Protocol version')
+    parser.add_argument('--channel_bits', type=int, default=8, help='v2 channel bits')
+    parser.add_argument('--delta', action='store_true', default=False, help='Send v2 deltas')
+    parser.add_argument('--window', type=int, default=4,
+                        help='Writer window, or 0 for synchronous writers')
+    parser.add_argument('--verbose', action='store_true', default=False,
+                        help='Show walle logging on the console')
+    args = parser.parse_args()
+
+    assert 0. <= args.loss < 1.
+    if not args.verbose:
+        walle._log_console_handler.setLevel(logging.WARNING)
+
+    server = None
+    if args.host is None:
+        conn, server_conn = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=_serve,
+                                         args=(server_conn, args.rows, args.cols, args.loss),
+                                         daemon=True)
+        server.start()
+        host, port = '127.0.0.1', conn.recv()
+    else:
+        host, port = args.host, args.port
+
+    def make_client(**kwargs):
+        driver = walle.UdpLedDisplay(host, port, args.rows, args.cols, protocol=args.protocol,
+                                     channel_bits=args.channel_bits, **kwargs)
+        if args.loss:
+            driver.socket = _LossySocket(driver.socket, args.loss)
+        return driver
+
+    frames = [np.random.rand(args.rows, args.cols, 3).astype(np.float32) for _ in range(8)]
+    writer_results = []
+    poller_results = []
+    deadline = time.perf_counter() + args.duration
+    threads = []
+    for _ in range(args.writers):
+        driver = make_client(delta=args.delta, window=args.window or None,
+                             synchronous=not args.window)
+        threads.append(threading.Thread(target=_write,
+                                        args=(driver, frames, args.write_hz, deadline,
+                                              writer_results)))
+    for _ in range(args.pollers):
+        threads.append(threading.Thread(target=_poll,
+                                        args=(make_client(), args.poll_hz, deadline,
+                                              poller_results)))
+    t0 = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - t0
+
+    if writer_results:
+        rtts = walle.Stats('writer ack rtt', walle.log)
+        for r in writer_results:
+            rtts.merge(r[3])
+        num_sets = sum(r[0] for r in writer_results)
+        print('writers: {} sets ({:.1f}/s), {} lost, {} timeouts'.format(
+            num_sets, num_sets / elapsed, sum(r[1] for r in writer_results),
+            sum(r[2] for r in writer_results)))
+        print('  ack rtt: {}'.format(_format_ms(rtts.percentiles(PERCENTILES))))
+    if poller_results:
+        latencies = [t for r in poller_results for t in r[0]]
+        print('pollers: {} gets ({:.1f}/s), {} failed'.format(
+            len(latencies), len(latencies) / elapsed, sum(r[1] for r in poller_results)))
+        print('  get latency: {}'.format(_format_ms(
+            np.quantile(latencies, PERCENTILES) if latencies else None)))
+
+    if server is not None:
+        conn.send(None)
+        counts, cpu = conn.recv()
+        server.join()
+        print('server: {} actuated ({:.1f}/s), {} skipped, {} missing, {} repeated, '
+              '{} malformed'.format(counts['actuated'], counts['actuated'] / elapsed,
+                                    counts['skipped'], counts['missing'], counts['repeated'],
+                                    counts['malformed']))
+        print('  {} wakeups, {} hit the per-wakeup cap ({:.1%})'.format(
+            counts['wakeups'], counts['capped_wakeups'],
+            counts['capped_wakeups'] / max(counts['wakeups'], 1)))
+        print('  cpu {:.2f}s ({:.0%} of a core)'.format(cpu, cpu / elapsed))
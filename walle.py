@@ -1,22 +1,53 @@
 #!/usr/bin/env python
 
 import argparse
+import array
+import asyncio
+import atexit
+from collections import namedtuple
 from contextlib import contextmanager
 import colour
-import copy
+import concurrent.futures
+import heapq
+import http.server
+import ipaddress
+import itertools
+import json
 import logging, logging.handlers
+import mmap
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
 import os
 import re
 import select
+import signal
 import socket
 import spidev
 import struct
+import tempfile
+import threading
 import time
+import weakref
+import zlib
 
 DEFAULT_NUM_ROWS = 10
 DEFAULT_NUM_COLS = 10
 
 DEFAULT_UDP_SERVER_PORT = 4513
+DEFAULT_SHM_NAME = 'walle'
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+DEFAULT_PROTOCOL = PROTOCOL_V2
+
+# in delta mode, a keyframe is sent at least this often (in frames)
+DEFAULT_KEYFRAME_INTERVAL = 100
+
+# keeps v2 datagrams within a standard 1500-byte ethernet MTU, so the IP layer never fragments
+DEFAULT_MAX_DATAGRAM_SIZE = 1472
+_MAX_RECV_SIZE = 65535
+# v1 messages are never fragmented, so a v1 ack has to fit in one UDP datagram (over IPv4)
+_MAX_V1_DATAGRAM_SIZE = 65507
 
 log = logging.getLogger('walle')
 log.setLevel('DEBUG')
@@ -39,8 +70,121 @@ def colour_to_8bit(color):
     assert type(color) == colour.Color
     return tuple(int(255 * ch) for ch in color.rgb)
 
+class _LogHistogram:
+    """
+    log-bucketed histogram with 8 buckets per power of two (~9% relative resolution) for magnitudes
+    in [2^(MIN_EXP - 1), 2^MAX_EXP), for both signs, plus a bucket for zero. magnitudes beyond the
+    range are clamped into it.
+
+    add() has to be cheap enough for hot paths, so it only queues the value. queued values are
+    binned with numpy whenever the counts are read, or once BATCH_SIZE of them pile up. buckets are
+    indexed straight off frexp(): the mantissa m is in [0.5, 1) for positive values, (-1, -0.5] for
+    negative ones and 0 for zero, so int(16 * m) picks one of 8 buckets per exponent without any
+    branching on the sign. negative buckets land in their own slots of each 32-wide exponent row.
+    the slots are sorted out by value only when percentiles are computed. infinities and NaNs have
+    no bucket and are only counted in num_non_finite.
+
+    values may be queued from one thread while others flush (e.g. the prometheus exporter). flushes
+    are serialized by a lock, and only ever take the values that were queued when they started.
+    """
+    MIN_EXP = -30
+    MAX_EXP = 34
+    BATCH_SIZE = 4096
+    _ROW = 32
+    _OFFSET = (1 - MIN_EXP) * _ROW
+    _SIZE = (MAX_EXP + 2 - MIN_EXP) * _ROW
+
+    def __init__(self):
+        self.counts = np.zeros(self._SIZE, dtype=np.int64)
+        self.num_non_finite = 0
+        self.total_sum = 0.
+        self.pending = []
+        self._lock = threading.Lock()
+
+    def add(self, val):
+        self.pending.append(val)
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self._lock:
+            # cleared in place, so callers can hold on to pending.append. the slice and the del are
+            # each atomic, and values appended in between land past the first num_vals.
+            num_vals = len(self.pending)
+            vals = np.array(self.pending[:num_vals], dtype=np.float64)
+            del self.pending[:num_vals]
+            self.total_sum += float(vals.sum())
+            finite = np.isfinite(vals)
+            self.num_non_finite += len(vals) - int(np.count_nonzero(finite))
+            m, e = np.frexp(vals[finite])
+            e = np.clip(e, self.MIN_EXP, self.MAX_EXP)
+            i = e * self._ROW + (m * 16).astype(np.int64) + self._OFFSET
+            # replaced rather than updated in place, so readers never see a partial update
+            self.counts = np.asarray(self.counts) + np.bincount(i, minlength=self._SIZE)
+
+    def merge(self, other):
+        # adds the other histogram's samples to this one
+        other.flush()
+        with self._lock:
+            self.counts = np.asarray(self.counts) + other.counts
+            self.num_non_finite += other.num_non_finite
+            self.total_sum += other.total_sum
+
+    def num_samples(self):
+        self.flush()
+        return int(np.sum(self.counts)) + self.num_non_finite
+
+    def snapshot(self):
+        self.flush()
+        return np.array(self.counts)
+
+    def percentiles(self, qs, baseline=None):
+        """
+        returns the value at each quantile in qs (e.g. 0.99), counting only samples added since the
+        baseline snapshot, or None if there are none. values are bucket midpoints.
+        """
+        self.flush()
+        counts = np.array(self.counts)
+        if baseline is not None:
+            counts -= np.array(baseline)
+        order, values = _histogram_slot_order()
+        cumulative = np.cumsum(counts[order])
+        total = cumulative[-1]
+        if total == 0:
+            return None
+        ranks = np.maximum(np.ceil(np.array(qs) * total), 1)
+        return [float(v) for v in values[np.searchsorted(cumulative, ranks)]]
+
+_histogram_slot_order_cache = []
+
+def _histogram_slot_order():
+    """
+    returns the _LogHistogram slots that are actually used, in ascending value order, along with
+    their bucket midpoint values
+    """
+    if not _histogram_slot_order_cache:
+        h = _LogHistogram
+        rows, cols = np.divmod(np.arange(h._SIZE) - h._OFFSET, h._ROW)
+        values = np.full(h._SIZE, np.nan)
+        positive = (cols >= 8) & (cols < 16)
+        values[positive] = np.ldexp((cols[positive] + 0.5) / 16., rows[positive])
+        negative = (cols > 16) & (cols <= 24)
+        values[negative] = np.ldexp((cols[negative] - 32 - 0.5) / 16., rows[negative] + 1)
+        values[h._OFFSET] = 0.
+        slots = np.flatnonzero(~np.isnan(values))
+        order = slots[np.argsort(values[slots])]
+        _histogram_slot_order_cache.append((order, values[order]))
+    return _histogram_slot_order_cache[0]
+
+# every Stats registers itself here, so all of them can be exported at once
+_stats_registry = weakref.WeakSet()
+_stats_ids = itertools.count()
+
 class Stats:
     DEFAULT_PERIOD = 1000
+    PERCENTILES = (0.5, 0.9, 0.99, 0.999)
 
     def __init__(self, name, logger, period=DEFAULT_PERIOD):
         assert period > 0
@@ -53,22 +197,249 @@ class Stats:
         self._sum = None
         self._num= 0
 
+        # the histogram and totals are cumulative for exporting. the periodic log line reports
+        # percentiles relative to a snapshot taken at the previous log line.
+        self._id = next(_stats_ids)
+        self._hist = _LogHistogram()
+        self._hist_add = self._hist.pending.append
+        self._hist_baseline = None
+        _stats_registry.add(self)
+
     def sample(self, val):
         self._min = val if self._min is None else min(val, self._min)
         self._max = val if self._max is None else max(val, self._max)
         self._sum = val if self._sum is None else val + self._sum
         self._num += 1
+        # _LogHistogram.add() without the batch size check, to keep this cheap on hot paths. the
+        # queue is binned when the period ends, so it never holds more than one period of samples.
+        self._hist_add(val)
         if self._num >= self._period:
-            self._logger.info('{} min={:.3f} avg={:.3f} max={:.3f} num={}'.format(
-                self._name, self._min, self._sum / self._num, self._max, self._num))
+            ps = self._hist.percentiles(self.PERCENTILES, self._hist_baseline)
+            self._logger.info('{} min={:.3f} avg={:.3f} max={:.3f} {} num={}'.format(
+                self._name, self._min, self._sum / self._num, self._max,
+                ' '.join('p{:g}={:.3f}'.format(100 * q, min(max(p, self._min), self._max))
+                         for q, p in zip(self.PERCENTILES, ps or ())),
+                self._num))
+            self._hist_baseline = self._hist.snapshot()
             self._min = None
             self._max = None
             self._sum = None
             self._num = 0
 
+    def name(self):
+        return self._name
+
+    def percentiles(self, qs=PERCENTILES):
+        # over all samples so far
+        return self._hist.percentiles(qs)
+
+    def merge(self, other):
+        """
+        adds all of the other Stats' samples so far to this one's percentiles and exported totals,
+        e.g. to summarize several clients. the periodic log line only covers sample() calls.
+        """
+        self._hist.merge(other._hist)
+
+def format_prometheus():
+    """
+    returns every live Stats in Prometheus text exposition format, as a summary with cumulative
+    quantiles. stats can share names, so each also gets its unique id as a label.
+    """
+    lines = ['# HELP walle_stats walle.Stats samples', '# TYPE walle_stats summary']
+    for stats in sorted(list(_stats_registry), key=lambda stats: (stats._name, stats._id)):
+        labels = 'name="{}",id="{}"'.format(stats._name.replace('\\', '\\\\').replace('"', '\\"'),
+                                            stats._id)
+        ps = stats.percentiles(Stats.PERCENTILES) or [float('nan')] * len(Stats.PERCENTILES)
+        for q, p in zip(Stats.PERCENTILES, ps):
+            lines.append('walle_stats{{{},quantile="{:g}"}} {!r}'.format(labels, q, p))
+        lines.append('walle_stats_sum{{{}}} {!r}'.format(labels, stats._hist.total_sum))
+        lines.append('walle_stats_count{{{}}} {}'.format(labels, stats._hist.num_samples()))
+    return '\n'.join(lines) + '\n'
+
+def dump_prometheus(path):
+    # written atomically, so e.g. the node_exporter textfile collector never sees a partial file
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(format_prometheus())
+    os.replace(tmp_path, path)
+
+def dump_prometheus_on_signal(path, signum=signal.SIGUSR1):
+    # dumped from a thread: the handler may interrupt a histogram flush on the main thread, and
+    # would wait on its lock forever
+    signal.signal(signum, lambda *_: threading.Thread(target=dump_prometheus, args=(path,),
+                                                      name='stats dump').start())
+    log.info('send signal {} to pid {} to dump stats to {}'.format(signum, os.getpid(), path))
+
+def serve_prometheus(port, host=''):
+    """
+    serves the stats at http://host:port/metrics from a background thread
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = format_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='prometheus', daemon=True).start()
+    log.info('serving stats on http://{}:{}/metrics'.format(host or '*', server.server_port))
+    return server
+
+# opt-in tracing. while _tracer is None (the default), instrumented code pays only for that check.
+_tracer = None
+_trace_names = [] # name id -> name
+_trace_name_ids = {} # name -> name id
+
+def _trace_name_id(name):
+    # names are interned up front so recording a span stores only numbers
+    if name not in _trace_name_ids:
+        _trace_name_ids[name] = len(_trace_names)
+        _trace_names.append(name)
+    return _trace_name_ids[name]
+
+class _TraceBuffer:
+    """
+    fixed-size ring of the most recent trace events. events are stored into preallocated arrays, so
+    recording one allocates nothing that outlives the call, and the oldest events are overwritten
+    once the ring is full. slots are claimed with an itertools counter, which is atomic under the
+    GIL, so any thread can record.
+    """
+    SPAN = 0
+    INSTANT = 1
+
+    def __init__(self, capacity):
+        assert capacity > 0
+        self._capacity = capacity
+        self._next = itertools.count()
+        # array.array rather than numpy, since storing single items is several times faster
+        self._kinds = array.array('B', bytes(capacity))
+        self._name_ids = array.array('i', [0]) * capacity
+        self._thread_ids = array.array('Q', [0]) * capacity
+        self._starts = array.array('d', [0.]) * capacity
+        self._durations = array.array('d', [0.]) * capacity
+        self._num_recorded = 0
+
+    def record(self, kind, name_id, start, duration):
+        n = next(self._next)
+        i = n % self._capacity
+        self._kinds[i] = kind
+        self._name_ids[i] = name_id
+        self._thread_ids[i] = threading.get_ident()
+        self._starts[i] = start
+        self._durations[i] = duration
+        self._num_recorded = n + 1
+
+    def events(self):
+        """
+        returns the buffered events, oldest first, as (kind, name, thread id, start, duration)
+        """
+        num = min(self._num_recorded, self._capacity)
+        first = self._num_recorded - num
+        return [(self._kinds[i], _trace_names[self._name_ids[i]], self._thread_ids[i],
+                 self._starts[i], self._durations[i])
+                for i in (n % self._capacity for n in range(first, first + num))]
+
+    def num_dropped(self):
+        return max(self._num_recorded - self._capacity, 0)
+
+def enable_tracing(capacity=65536, path=None, signum=signal.SIGUSR2):
+    """
+    starts recording trace events into a ring buffer of the given capacity. if a path is given, the
+    buffer is dumped there as Chrome trace JSON (for chrome://tracing or ui.perfetto.dev) whenever
+    signum is received, and at exit.
+    """
+    global _tracer
+    _tracer = _TraceBuffer(capacity)
+    if path is not None:
+        atexit.register(lambda: dump_trace(path))
+        if signum is not None:
+            # dumped from a thread, as with the stats: formatting and writing a full buffer takes
+            # a while, and a handler stalls the main thread for all of it
+            signal.signal(signum, lambda *_: threading.Thread(target=dump_trace, args=(path,),
+                                                              name='trace dump').start())
+            log.info('send signal {} to pid {} to dump a trace to {}'.format(signum, os.getpid(),
+                                                                             path))
+    log.info('tracing enabled, keeping the last {} events'.format(capacity))
+
+def disable_tracing():
+    global _tracer
+    _tracer = None
+
+def format_trace():
+    """
+    returns the buffered trace events in Chrome trace event JSON format, or None if tracing is not
+    enabled
+    """
+    tracer = _tracer
+    if tracer is None:
+        return None
+    pid = os.getpid()
+    thread_names = {t.ident: t.name for t in threading.enumerate()}
+    events = []
+    for kind, name, tid, start, duration in tracer.events():
+        event = {'name': name, 'pid': pid, 'tid': tid, 'ts': start * 1e6}
+        if kind == _TraceBuffer.SPAN:
+            event.update(ph='X', dur=duration * 1e6)
+        else:
+            event.update(ph='i', s='t', args={'period_ms': duration * 1e3})
+        events.append(event)
+    for tid in sorted({event['tid'] for event in events}):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                       'args': {'name': thread_names.get(tid, str(tid))}})
+    return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'dropped_events': tracer.num_dropped()}})
+
+def dump_trace(path):
+    trace = format_trace()
+    if trace is None:
+        return
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(trace)
+    os.replace(tmp_path, path)
+    log.info('dumped trace to {}'.format(path))
+
+class TraceSpan:
+    """
+    records a span in the trace (if tracing is enabled) for each start()/stop() pair, without
+    keeping stats like IntervalProfiler does
+    """
+    def __init__(self, name):
+        self._name_id = _trace_name_id(name)
+        self._t0 = None
+
+    @contextmanager
+    def measure(self):
+        self.start()
+        yield
+        self.stop()
+
+    def start(self):
+        if _tracer is not None:
+            self._t0 = time.perf_counter()
+
+    def stop(self):
+        # spans started before tracing was enabled are not recorded
+        if self._t0 is not None:
+            tracer = _tracer
+            if tracer is not None:
+                tracer.record(_TraceBuffer.SPAN, self._name_id, self._t0,
+                              time.perf_counter() - self._t0)
+            self._t0 = None
+
 class IntervalProfiler:
     def __init__(self, name, logger, period=Stats.DEFAULT_PERIOD):
         self._stats = Stats(name + ' time', logger, period)
+        self._trace_name_id = _trace_name_id(name)
         self._t0 = None
 
     @contextmanager
@@ -84,16 +455,24 @@ class IntervalProfiler:
     def stop(self):
         assert self._t0 is not None
         t = time.perf_counter() - self._t0
+        tracer = _tracer
+        if tracer is not None:
+            tracer.record(_TraceBuffer.SPAN, self._trace_name_id, self._t0, t)
         self._t0 = None
         self._stats.sample(t)
 
 class PeriodProfiler:
     def __init__(self, name, logger, period=Stats.DEFAULT_PERIOD):
         self._stats = Stats(name + ' period', logger, period)
+        self._trace_name_id = _trace_name_id(name)
         self._then = None
 
     def mark(self):
         now = time.perf_counter()
+        tracer = _tracer
+        if tracer is not None:
+            tracer.record(_TraceBuffer.INSTANT, self._trace_name_id, now,
+                          0. if self._then is None else now - self._then)
         if self._then is None:
             self._then = now
         else:
@@ -104,6 +483,7 @@ class PeriodFloor:
     def __init__(self, period):
         self._then = None
         self._stats = Stats('period floor delta time', log)
+        self._sleep_span = TraceSpan('period floor sleep')
         self._period = period
 
     def sleep(self):
@@ -111,32 +491,69 @@ class PeriodFloor:
             t = self._period - (time.perf_counter() - self._then)
             self._stats.sample(t)
             if t > 0:
+                self._sleep_span.start()
                 time.sleep(t)
+                self._sleep_span.stop()
         self._then = time.perf_counter()
 
     def get_period(self):
         return self._period
 
+def as_frame(matrix):
+    """
+    frames are (rows, cols, 3) ndarrays of either float32 channels in [0, 1] or uint8 channels in
+    [0, 255]. both are passed through untouched (no copy). anything else, including the legacy
+    nested-list-of-3-tuples form, is converted to a float32 frame.
+    """
+    if isinstance(matrix, np.ndarray) and matrix.dtype in (np.float32, np.uint8):
+        frame = matrix
+    else:
+        frame = np.asarray(matrix, dtype=np.float32)
+    assert frame.ndim == 3 and frame.shape[2] == 3, 'bad frame shape {}'.format(frame.shape)
+    assert frame.shape[0] > 0 and frame.shape[1] > 0
+    return frame
+
+def copy_frame(matrix):
+    # like as_frame(), but the result is guaranteed to not alias the caller's matrix
+    frame = as_frame(matrix)
+    return frame.copy() if frame is matrix else frame
+
+def frame_to_float(frame):
+    frame = as_frame(frame)
+    if frame.dtype == np.uint8:
+        return np.multiply(frame, np.float32(1. / 255.), dtype=np.float32)
+    return frame
+
+def frame_to_uint8(frame):
+    frame = as_frame(frame)
+    if frame.dtype == np.float32:
+        # out-of-range channels would silently wrap around in the cast
+        assert _frame_in_range(frame), 'channel values out of bounds'
+        return (frame * 255. + 0.5).astype(np.uint8)
+    return frame
+
+def _frame_in_range(frame):
+    # uint8 frames are always in range. note this also rejects NaN channels.
+    return frame.dtype == np.uint8 or bool(((frame >= 0.) & (frame <= 1.)).all())
+
 def all_off_matrix(dim):
     # expected to return a copy
-    return [[(0., 0., 0.) for _ in range(dim[0])] for _ in range(dim[1])]
+    return np.zeros((dim[0], dim[1], 3), dtype=np.float32)
 
 def all_on_matrix(dim):
     # expected to return a copy
-    return [[(1., 1., 1.) for _ in range(dim[0])] for _ in range(dim[1])]
+    return np.ones((dim[0], dim[1], 3), dtype=np.float32)
 
 def _get_dim(matrix):
-    assert len(matrix) > 0
-    assert len(set(len(row) for row in matrix)) == 1
-    return len(matrix), len(matrix[0])
+    frame = as_frame(matrix)
+    return frame.shape[0], frame.shape[1]
 
 def _pack_udp(matrix, msg_seq):
-    # Verify all rows are the same size
     header = struct.pack('>I', msg_seq)
     if matrix is not None:
-        num_rows, num_cols = _get_dim(matrix)
-        chs = (ch for row in matrix for color in row for ch in color)
-        payload = struct.pack('>II{}f'.format(3 * num_rows * num_cols), num_rows, num_cols, *chs)
+        frame = frame_to_float(matrix)
+        num_rows, num_cols = frame.shape[:2]
+        payload = struct.pack('>II', num_rows, num_cols) + frame.astype('>f4').tobytes()
         assert len(payload) == 8 + 4 * 3 * num_rows * num_cols
     else:
         payload = bytes()
@@ -150,32 +567,647 @@ def _unpack_udp(data):
     if len(payload):
         if len(payload) % 4 != 0:
             raise RuntimeError('invalid packet size {}'.format(len(data)))
-        num_chs = int((len(payload) - 8) / 4) # truncation will be detected by struct.unpack
-        try:
-            num_rows, num_cols, *chs = struct.unpack('>II{}f'.format(num_chs), payload)
-        except struct.error as e:
-            raise RuntimeError(str(e))
-        if num_chs != 3 * num_rows * num_cols:
-            raise RuntimeError('received dimensions {}x{} do not match channel count'.format(
+        num_rows, num_cols = struct.unpack('>II', payload[:8])
+        num_chs = (len(payload) - 8) // 4
+        if num_chs != 3 * num_rows * num_cols or num_chs == 0:
+            raise RuntimeError('received dimensions {}x{} do not match channel count {}'.format(
                 num_rows, num_cols, num_chs))
-        if min(chs) < 0 or max(chs) > 1.0:
+        chs = np.frombuffer(payload, dtype='>f4', offset=8)
+        matrix = chs.astype(np.float32).reshape(num_rows, num_cols, 3)
+        if not _frame_in_range(matrix):
             raise RuntimeError('received channels contain values out of bounds')
-        colors = [tuple(chs[i:i + 3]) for i in range(0, len(chs), 3)]
-        matrix = [colors[i:i + num_cols] for i in range(0, len(colors), num_cols)]
     else:
         matrix = None
     return matrix, msg_seq
 
+# Protocol v2 datagram header. v1 datagrams start with a bare 32-bit sequence number, so v2 is
+# recognized by its magic and version bytes. a v1 sequence number can in principle collide with
+# these, but only once every ~4 billion messages.
+#
+#   magic         2s  b'WL'
+#   version       B   2
+#   flags         B   _V2_FLAG_* bits
+#   msg_seq       I   shared by all fragments of a message
+#   encoding      B   _V2_ENCODING_* describing the reassembled body
+#   channel_bits  B   8 or 16
+#   frag_index    H   index of this fragment
+#   frag_count    H   total fragments in the message
+#   num_rows      H   frame dimensions, 0x0 if there is no frame
+#   num_cols      H
+#
+# the message body is the concatenation of all fragment payloads in index order. requests carry the
+# channel depth the client wants its acknowledgement in.
+_V2_MAGIC = b'WL'
+_V2_HEADER = struct.Struct('>2sBBIBBHHHH')
+_V2_FLAGS_OFFSET = 3
+_V2_MSG_SEQ_OFFSET = 4
+
+_V2_ENCODING_NONE = 0  # no body: a query request, or an ack-only reply
+_V2_ENCODING_FULL = 1  # a full frame of big-endian channels
+_V2_ENCODING_DELTA_PIXELS = 2  # changed pixels relative to an acknowledged keyframe
+_V2_ENCODING_DELTA_RECTS = 3  # dirty rectangles relative to an acknowledged keyframe
+_V2_ENCODING_CLIP = 4  # full frames for the receiver to store and play back later
+_V2_ENCODING_CLIP_PLAY = 5  # play a stored clip
+_V2_ENCODING_CLIP_PART = 6  # a consecutive part of a clip body too big to send as one message
+
+_V2_FLAG_KEYFRAME = 0x01  # request: the receiver should keep this full frame as a delta reference
+_V2_FLAG_NEED_KEYFRAME = 0x02  # ack: a delta could not be applied, send a keyframe
+_V2_FLAG_ACK_ONLY = 0x04  # request: acknowledge with a bare header instead of the current frame
+_V2_FLAG_NEED_CLIP = 0x08  # ack: the clip to play is not stored, upload it again
+_V2_FLAG_TIMESTAMP = 0x10  # the body starts with a _V2_TIMESTAMP: when to show the frame on
+                           # requests, the sender's clock on acks
+_V2_FLAG_CLOCK = 0x20  # request: timestamp the ack with the server's clock
+
+_V2_CHANNEL_DTYPES = {8: np.dtype('u1'), 16: np.dtype('>u2')}
+
+# delta bodies start with the msg_seq of their reference keyframe and an element count. pixel deltas
+# follow with the flat pixel indices and then their channels. rectangle deltas follow with (row,
+# col, num_rows, num_cols) rectangles and then the channels of each rectangle in turn.
+_V2_DELTA_HEADER = struct.Struct('>II')
+_V2_DELTA_RECT = np.dtype([('row', '>u2'), ('col', '>u2'), ('num_rows', '>u2'),
+                           ('num_cols', '>u2')])
+_V2_DELTA_TILE_SIZE = 4
+
+# clip bodies are this header followed by the frames' channels, like full frames back to back. play
+# bodies are just the clip id and whether to loop.
+_V2_CLIP_HEADER = struct.Struct('>III') # clip id, frame count, frame period in microseconds
+_V2_CLIP_PLAY = struct.Struct('>IB')
+
+# clip bodies bigger than this are sent as parts, each acknowledged before the next goes out. a whole
+# clip sent as one burst of fragments overflows the receiver's socket buffer (about 208 KiB by
+# default on linux), and then every retry loses fragments the same way. part bodies are this header
+# followed by the part's bytes of the clip body.
+_V2_CLIP_PART_SIZE = 64 * 1024
+_V2_CLIP_PART = struct.Struct('>III') # clip id, offset of the part in the clip body, clip body size
+
+# timestamps are seconds on the sender's time.time() clock. the wall clock, unlike perf_counter(),
+# is shared (to within NTP's precision) by the servers of a multicast group, which answer a
+# client's clock probes interchangeably.
+_V2_TIMESTAMP = struct.Struct('>d')
+
+_V2Header = namedtuple('_V2Header', 'version flags msg_seq encoding channel_bits frag_index '
+                                    'frag_count num_rows num_cols')
+_V2Message = namedtuple('_V2Message', 'msg_seq flags encoding channel_bits dim body timestamp')
+
+def _is_v2(data):
+    return len(data) >= _V2_HEADER.size and data[:2] == _V2_MAGIC and data[2] == PROTOCOL_V2
+
+def _quantize_v2(frame, channel_bits):
+    """
+    returns the frame's channels as they will appear on the wire, as a native uint8/uint16 array
+    """
+    frame = as_frame(frame)
+    if channel_bits == 8:
+        return frame_to_uint8(frame)
+    elif channel_bits == 16:
+        if frame.dtype == np.uint8:
+            # 257 maps [0, 255] exactly onto [0, 65535]
+            return frame.astype(np.uint16) * np.uint16(257)
+        assert _frame_in_range(frame), 'channel values out of bounds'
+        return (frame * 65535. + 0.5).astype(np.uint16)
+    raise ValueError('unsupported channel depth {}'.format(channel_bits))
+
+def _quantized_to_frame(chs, channel_bits):
+    if channel_bits == 16:
+        return np.multiply(chs, np.float32(1. / 65535.), dtype=np.float32)
+    return chs
+
+def _encode_v2_frame(frame, channel_bits):
+    chs = _quantize_v2(frame, channel_bits)
+    return chs.astype(_V2_CHANNEL_DTYPES[channel_bits], copy=False).tobytes()
+
+def _decode_v2_channels(message):
+    """
+    returns the wire channels of a full frame message as a (rows, cols, 3) array. 8-bit channels
+    are a view of the message body (read-only if the body is bytes).
+    """
+    num_rows, num_cols = message.dim
+    chs = np.frombuffer(message.body, dtype=_V2_CHANNEL_DTYPES[message.channel_bits])
+    return chs.reshape(num_rows, num_cols, 3)
+
+def _decode_v2_frame(message):
+    """
+    8-bit frames are returned as a uint8 view of the message body. 16-bit frames are scaled to
+    float32.
+    """
+    return _quantized_to_frame(_decode_v2_channels(message), message.channel_bits)
+
+def _dirty_rects(mask, tile_size=_V2_DELTA_TILE_SIZE):
+    """
+    covers the set cells of a 2D mask with rectangles: the mask is divided into tiles, and each run
+    of dirty tiles within a row of tiles becomes one rectangle. returns (row, col, rows, cols) tuples.
+    """
+    num_rows, num_cols = mask.shape
+    pad = ((0, -num_rows % tile_size), (0, -num_cols % tile_size))
+    padded = np.pad(mask, pad)
+    tiles = padded.reshape(padded.shape[0] // tile_size, tile_size,
+                           padded.shape[1] // tile_size, tile_size).any(axis=(1, 3))
+    rects = []
+    for tile_row in np.flatnonzero(tiles.any(axis=1)):
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], tiles[tile_row].astype(np.int8), [0]))))
+        row = tile_row * tile_size
+        rect_rows = min(tile_size, num_rows - row)
+        for start, stop in zip(edges[::2] * tile_size, edges[1::2] * tile_size):
+            rects.append((row, start, rect_rows, min(stop, num_cols) - start))
+    return rects
+
+def _encode_v2_delta(chs, ref_chs, ref_seq, channel_bits):
+    """
+    encodes quantized channels against the quantized reference keyframe, choosing whichever of the
+    pixel or rectangle encodings is smaller. returns (encoding, body), or None if a full frame would
+    be no bigger.
+    """
+    dtype = _V2_CHANNEL_DTYPES[channel_bits]
+    mask = (chs != ref_chs).any(axis=2)
+    pixels = np.flatnonzero(mask)
+    pixels_size = _V2_DELTA_HEADER.size + len(pixels) * (4 + 3 * dtype.itemsize)
+    rects = _dirty_rects(mask)
+    rects_size = _V2_DELTA_HEADER.size + len(rects) * _V2_DELTA_RECT.itemsize + \
+        sum(r[2] * r[3] for r in rects) * 3 * dtype.itemsize
+    if min(pixels_size, rects_size) >= chs.size * dtype.itemsize:
+        return None
+
+    if pixels_size <= rects_size:
+        values = chs.reshape(-1, 3)[pixels]
+        body = b''.join((_V2_DELTA_HEADER.pack(ref_seq, len(pixels)),
+                         pixels.astype('>u4').tobytes(),
+                         values.astype(dtype, copy=False).tobytes()))
+        return _V2_ENCODING_DELTA_PIXELS, body
+    else:
+        chunks = [_V2_DELTA_HEADER.pack(ref_seq, len(rects)),
+                  np.array(rects, dtype=_V2_DELTA_RECT).tobytes()]
+        chunks.extend(chs[row:row + rows, col:col + cols].astype(dtype, copy=False).tobytes()
+                      for row, col, rows, cols in rects)
+        return _V2_ENCODING_DELTA_RECTS, b''.join(chunks)
+
+def _v2_delta_ref_seq(message):
+    return _V2_DELTA_HEADER.unpack_from(message.body)[0]
+
+def _apply_v2_delta(message, ref_chs):
+    """
+    returns new quantized channels with the delta message applied to a copy of the reference
+    keyframe channels. raises RuntimeError if the delta is malformed.
+    """
+    dtype = _V2_CHANNEL_DTYPES[message.channel_bits]
+    body = message.body
+    _, num_elements = _V2_DELTA_HEADER.unpack_from(body)
+    offset = _V2_DELTA_HEADER.size
+    chs = ref_chs.copy()
+    try:
+        if message.encoding == _V2_ENCODING_DELTA_PIXELS:
+            pixels = np.frombuffer(body, dtype='>u4', count=num_elements, offset=offset)
+            values = np.frombuffer(body, dtype=dtype, count=3 * num_elements,
+                                   offset=offset + 4 * num_elements)
+            if offset + len(pixels) * 4 + values.nbytes != len(body):
+                raise RuntimeError('trailing bytes in pixel delta')
+            if num_elements and pixels.max() >= chs.shape[0] * chs.shape[1]:
+                raise RuntimeError('pixel delta index out of range')
+            chs.reshape(-1, 3)[pixels] = values.reshape(-1, 3)
+        else:
+            rects = np.frombuffer(body, dtype=_V2_DELTA_RECT, count=num_elements, offset=offset)
+            offset += rects.nbytes
+            for row, col, rows, cols in rects.tolist():
+                if row + rows > chs.shape[0] or col + cols > chs.shape[1]:
+                    raise RuntimeError('rectangle delta out of range')
+                count = rows * cols * 3
+                values = np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+                chs[row:row + rows, col:col + cols] = values.reshape(rows, cols, 3)
+                offset += values.nbytes
+            if offset != len(body):
+                raise RuntimeError('trailing bytes in rectangle delta')
+    except ValueError as e:
+        # np.frombuffer raises ValueError for truncated bodies
+        raise RuntimeError('truncated delta: {}'.format(e))
+    return chs
+
+def _fragment_v2(body, msg_seq, encoding, channel_bits, dim, flags=0,
+                 max_datagram_size=DEFAULT_MAX_DATAGRAM_SIZE):
+    max_payload = max_datagram_size - _V2_HEADER.size
+    assert max_payload > 0
+    frag_count = max(1, -(-len(body) // max_payload))
+    if frag_count > 0xffff:
+        raise ValueError('message of {} bytes needs too many fragments'.format(len(body)))
+    view = memoryview(body)
+    return [_V2_HEADER.pack(_V2_MAGIC, PROTOCOL_V2, flags, msg_seq, encoding, channel_bits, i,
+                            frag_count, *dim) + view[i * max_payload:(i + 1) * max_payload]
+            for i in range(frag_count)]
+
+def _encode_v2_clip(frames, frame_period, channel_bits):
+    """
+    returns (clip id, body) for a clip message. the id is a hash of the contents, so uploading the
+    same clip again replaces it rather than taking up more room.
+    """
+    frames_body = b''.join(_encode_v2_frame(frame, channel_bits) for frame in frames)
+    period_us = max(int(round(frame_period * 1e6)), 1)
+    clip_id = zlib.crc32(struct.pack('>IB', period_us, channel_bits) + frames_body)
+    return clip_id, _V2_CLIP_HEADER.pack(clip_id, len(frames), period_us) + frames_body
+
+def _pack_v2(matrix, msg_seq, channel_bits=8, flags=0, max_datagram_size=DEFAULT_MAX_DATAGRAM_SIZE):
+    """
+    returns the list of datagrams carrying the frame (or a bodiless query/ack if matrix is None)
+    """
+    if matrix is not None:
+        frame = as_frame(matrix)
+        return _fragment_v2(_encode_v2_frame(frame, channel_bits), msg_seq, _V2_ENCODING_FULL,
+                            channel_bits, frame.shape[:2], flags, max_datagram_size)
+    return _fragment_v2(bytes(), msg_seq, _V2_ENCODING_NONE, channel_bits, (0, 0), flags,
+                        max_datagram_size)
+
+def _unpack_v2_datagram(data):
+    if not _is_v2(data):
+        raise RuntimeError('not a v2 datagram')
+    magic, *fields = _V2_HEADER.unpack_from(data)
+    header = _V2Header(*fields)
+    if header.channel_bits not in _V2_CHANNEL_DTYPES:
+        raise RuntimeError('unsupported channel depth {}'.format(header.channel_bits))
+    if header.frag_index >= header.frag_count:
+        raise RuntimeError('fragment {} of {} out of range'.format(header.frag_index,
+                                                                   header.frag_count))
+    return header, data[_V2_HEADER.size:]
+
+def _validate_v2_message(message):
+    num_rows, num_cols = message.dim
+    if message.encoding == _V2_ENCODING_NONE:
+        if message.body:
+            raise RuntimeError('unexpected {}-byte body'.format(len(message.body)))
+    elif message.encoding == _V2_ENCODING_FULL:
+        expected = 3 * num_rows * num_cols * _V2_CHANNEL_DTYPES[message.channel_bits].itemsize
+        if expected == 0 or len(message.body) != expected:
+            raise RuntimeError('received dimensions {}x{} do not match {}-byte body'.format(
+                num_rows, num_cols, len(message.body)))
+    elif message.encoding in (_V2_ENCODING_DELTA_PIXELS, _V2_ENCODING_DELTA_RECTS):
+        if num_rows * num_cols == 0 or len(message.body) < _V2_DELTA_HEADER.size:
+            raise RuntimeError('delta message too short')
+    elif message.encoding == _V2_ENCODING_CLIP:
+        if len(message.body) < _V2_CLIP_HEADER.size:
+            raise RuntimeError('clip message too short')
+        _, num_frames, period_us = _V2_CLIP_HEADER.unpack_from(message.body)
+        frame_size = 3 * num_rows * num_cols * _V2_CHANNEL_DTYPES[message.channel_bits].itemsize
+        if frame_size == 0 or num_frames == 0 or period_us == 0 or \
+           len(message.body) != _V2_CLIP_HEADER.size + num_frames * frame_size:
+            raise RuntimeError('bad clip of {} {}x{} frames in {} bytes'.format(
+                    num_frames, num_rows, num_cols, len(message.body)))
+    elif message.encoding == _V2_ENCODING_CLIP_PLAY:
+        if len(message.body) != _V2_CLIP_PLAY.size:
+            raise RuntimeError('bad {}-byte clip play message'.format(len(message.body)))
+    elif message.encoding == _V2_ENCODING_CLIP_PART:
+        if num_rows * num_cols == 0 or len(message.body) <= _V2_CLIP_PART.size:
+            raise RuntimeError('clip part message too short')
+        _, offset, size = _V2_CLIP_PART.unpack_from(message.body)
+        if offset + len(message.body) - _V2_CLIP_PART.size > size:
+            raise RuntimeError('clip part at {} overruns its {}-byte clip'.format(offset, size))
+    else:
+        raise RuntimeError('unknown encoding {}'.format(message.encoding))
+    return message
+
+class _V2Reassembler:
+    """
+    collects v2 fragments into complete messages, keyed on the sender and msg_seq. only a bounded
+    number of partial messages is kept per sender (and for max_senders senders); the oldest are
+    evicted since, with the server only ever actuating the freshest update, a message that has
+    fallen that far behind is worthless anyway. keeping the bound per sender means one client
+    streaming fragments can't evict everyone else's.
+
+    messages bigger than max_message_size bytes (if given), going by their fragment count or by
+    what has arrived, are rejected before they take up any more memory.
+    """
+    def __init__(self, max_partial=16, max_senders=64, max_message_size=None):
+        self._max_partial = max_partial
+        self._max_senders = max_senders
+        self._max_message_size = max_message_size
+        # sender -> {msg_seq: [first header, fragments, num missing, num bytes]}, least recently
+        # heard from sender first
+        self._partial = {}
+        self.num_evicted = 0
+
+    def add(self, addr, data):
+        """
+        returns the completed _V2Message, or None if more fragments are needed. raises RuntimeError
+        on malformed datagrams.
+        """
+        header, payload = _unpack_v2_datagram(data)
+        # all fragments but the last are full, so any other one bounds the message's size from below
+        declared_size = len(payload) * (header.frag_count - 1 if header.frag_index <
+                                        header.frag_count - 1 else 1)
+        if self._max_message_size is not None and declared_size > self._max_message_size:
+            raise RuntimeError('message {} of {} fragments is too big'.format(header.msg_seq,
+                                                                              header.frag_count))
+        if header.frag_count == 1:
+            return _validate_v2_message(self._message(header, payload))
+
+        # re-inserting keeps the dict ordered by recency, so the stalest sender is evicted
+        messages = self._partial.pop(addr, {})
+        self._partial[addr] = messages
+        while len(self._partial) > self._max_senders:
+            self.num_evicted += len(self._partial.pop(next(iter(self._partial))))
+        entry = messages.get(header.msg_seq)
+        if entry is None:
+            while len(messages) >= self._max_partial:
+                del messages[next(iter(messages))]
+                self.num_evicted += 1
+            entry = messages[header.msg_seq] = [header, [None] * header.frag_count,
+                                                header.frag_count, 0]
+        first_header, chunks, num_missing, num_bytes = entry
+        if header._replace(frag_index=0) != first_header._replace(frag_index=0):
+            self._discard(addr, header.msg_seq)
+            raise RuntimeError('fragment {} of message {} is inconsistent'.format(
+                header.frag_index, header.msg_seq))
+        if chunks[header.frag_index] is None:
+            entry[2] = num_missing = num_missing - 1
+            entry[3] = num_bytes = num_bytes + len(payload)
+            if self._max_message_size is not None and num_bytes > self._max_message_size:
+                self._discard(addr, header.msg_seq)
+                raise RuntimeError('message {} is too big'.format(header.msg_seq))
+        chunks[header.frag_index] = payload
+        if num_missing:
+            return None
+
+        self._discard(addr, header.msg_seq)
+        return _validate_v2_message(self._message(header, b''.join(chunks)))
+
+    def _discard(self, addr, msg_seq):
+        messages = self._partial[addr]
+        del messages[msg_seq]
+        if not messages:
+            del self._partial[addr]
+
+    def _message(self, header, body):
+        # the timestamp (if any) is split off the body here, so nothing else has to know about it
+        timestamp = None
+        if header.flags & _V2_FLAG_TIMESTAMP:
+            if len(body) < _V2_TIMESTAMP.size:
+                raise RuntimeError('message {} too short for its timestamp'.format(header.msg_seq))
+            timestamp = _V2_TIMESTAMP.unpack_from(body)[0]
+            body = memoryview(body)[_V2_TIMESTAMP.size:]
+        return _V2Message(header.msg_seq, header.flags, header.encoding, header.channel_bits,
+                          (header.num_rows, header.num_cols), body, timestamp)
+
+def _parse_target_options(spec):
+    # parses 'key=value,key=value' display target options. integer values are converted.
+    options = {}
+    for item in filter(None, spec.split(',')):
+        key, _, value = item.partition('=')
+        options[key] = int(value) if re.fullmatch('-?[0-9]+', value) else value
+    if 'chains' in options:
+        options['chains'] = _parse_spi_chains(str(options['chains']))
+    return options
+
+def _parse_spi_chains(value):
+    # parses SPI chains given as 'bus.index+bus.index', e.g. '0.0+0.1+1.0'
+    chains = []
+    for chain in value.split('+'):
+        match = re.fullmatch('([0-9]+)\\.([0-9]+)', chain)
+        if not match:
+            raise ValueError('bad spi chain {!r}, expected bus.index'.format(chain))
+        chains.append((int(match.group(1)), int(match.group(2))))
+    return chains
+
 def create_display(target):
-    if target == 'spi':
-        return LocalLedDisplay()
-    elif target == 'spi_no_gamma':
-        return LocalLedDisplay(gamma_correct=False)
+    """
+    'spi' and 'spi_no_gamma' targets accept LocalLedDisplay options, e.g.
+    'spi:wiring=progressive,first_row=top,rotation=90,num_rows=16,num_cols=16'. split chains are
+    given as bus.index pairs joined by '+', e.g. 'spi:num_rows=64,num_cols=64,chains=0.0+1.0'.
+
+    'shm:name' connects to a server on this machine listening on shared memory (--listen shm:name).
+    the name defaults to 'walle'.
+
+    'group:host1,host2:port,...' drives several walls in step as one GroupLedDisplay. options may
+    be mixed in, e.g. 'group:wall1,wall2,wall3,wall4,num_rows=16,num_cols=16,grid_cols=2,delay=0.1'
+    for a 2x2 grid of 16x16 walls shown 100 ms after each set().
+
+    'tiled:target@row,col;target@row,col,rotation;...' drives several targets as one TiledDisplay,
+    e.g. 'tiled:spi:index=0@0,0;spi:index=1@0,10,180' for two 10x10 panels side by side, the second
+    mounted upside down.
+    """
+    kind, _, spec = target.partition(':')
+    if kind == 'spi':
+        return LocalLedDisplay(**_parse_target_options(spec))
+    elif kind == 'spi_no_gamma':
+        return LocalLedDisplay(gamma_correct=False, **_parse_target_options(spec))
+    elif kind == 'fake_spi':
+        options = _parse_target_options(spec)
+        spi = [FakeSpiDev(simulate_timing=True) for _ in options.get('chains', [None])]
+        return LocalLedDisplay(spi=spi, **options)
     elif target == 'fake':
         return FakeDisplay()
+    elif kind == 'shm':
+        return SharedMemoryLedDisplay(spec or DEFAULT_SHM_NAME)
+    elif kind == 'group':
+        addrs = []
+        for item in spec.split(','):
+            if item and '=' not in item:
+                host, _, port = item.partition(':')
+                addrs.append((host, int(port) if port else DEFAULT_UDP_SERVER_PORT))
+        options = _parse_target_options(','.join(item for item in spec.split(',') if '=' in item))
+        if 'delay' in options:
+            options['presentation_delay'] = float(options.pop('delay'))
+        return GroupLedDisplay(addrs, **options)
+    elif kind == 'tiled':
+        tiles = []
+        for tile in spec.split(';'):
+            tile_target, _, placement = tile.rpartition('@')
+            tiles.append((create_display(tile_target), *(int(x) for x in placement.split(','))))
+        return TiledDisplay(tiles)
+    elif kind == 'record':
+        # 'record:path:target' records whatever is shown on target
+        path, _, inner_target = spec.partition(':')
+        display = RecordingDisplay(create_display(inner_target), path)
+        atexit.register(display.close)
+        return display
     else:
         return UdpLedDisplay(target)
 
+class TiledDisplay:
+    """
+    presents one logical display backed by a grid of sub-drivers (LocalLedDisplays on several
+    chip selects, UdpLedDisplays, fakes, ...). tiles are given as (driver, row, col) or (driver,
+    row, col, rotation) tuples: the driver shows the part of the logical frame whose top left
+    corner is at (row, col), rotated clockwise by rotation degrees, so a driver with dim (rows,
+    cols) covers rows x cols of the frame, or cols x rows when rotated by 90 or 270. the logical
+    dim is the bounding box of the tiles.
+
+    tiles are written concurrently, the first from the calling thread and the rest from a pool, so
+    a frame takes as long as the slowest tile rather than all of them in turn.
+    """
+    def __init__(self, tiles):
+        assert tiles
+        self._tiles = []
+        num_rows = num_cols = 0
+        for tile in tiles:
+            driver, row, col, rotation = (tuple(tile) + (0,))[:4]
+            assert rotation in (0, 90, 180, 270) and row >= 0 and col >= 0
+            rows, cols = driver.dim()
+            if rotation % 180:
+                rows, cols = cols, rows
+            self._tiles.append((driver, slice(row, row + rows), slice(col, col + cols),
+                                rotation // 90))
+            num_rows, num_cols = max(num_rows, row + rows), max(num_cols, col + cols)
+        self._dim = (num_rows, num_cols)
+        self._pool = None
+        if len(self._tiles) > 1:
+            self._pool = concurrent.futures.ThreadPoolExecutor(len(self._tiles) - 1,
+                                                               thread_name_prefix='tile')
+        log.info('using {}x{} display of {} tiles'.format(num_cols, num_rows, len(self._tiles)))
+
+    def dim(self):
+        return tuple(self._dim)
+
+    def set(self, matrix):
+        frame = as_frame(matrix)
+        assert _get_dim(frame) == self._dim
+        self._map(lambda driver, rows, cols, k: driver.set(np.rot90(frame[rows, cols], -k)))
+
+    def get(self):
+        # the tiles' frames put back together, or None if any of them doesn't have one
+        frame = all_off_matrix(self._dim)
+        tile_frames = self._map(lambda driver, rows, cols, k: driver.get())
+        for (_, rows, cols, k), tile_frame in zip(self._tiles, tile_frames):
+            if tile_frame is None:
+                return None
+            frame[rows, cols] = frame_to_float(np.rot90(as_frame(tile_frame), k))
+        return frame
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        for driver, _, _, _ in self._tiles:
+            if hasattr(driver, 'close'):
+                driver.close()
+
+    def _map(self, fn):
+        # calls fn(driver, rows, cols, rotation // 90) for every tile, concurrently, and returns
+        # the results in tile order
+        if self._pool is None:
+            return [fn(*tile) for tile in self._tiles]
+        futures = [self._pool.submit(fn, *tile) for tile in self._tiles[1:]]
+        first = fn(*self._tiles[0])
+        return [first] + [future.result() for future in futures]
+
+class RecordingDisplay:
+    """
+    wraps any display and records the frames set on it, with their times, to a file that
+    FrameRecording (e.g. replay.py) can play back.
+
+    the file is a fixed header followed by fixed-size records (a float64 timestamp, then the uint8
+    frame) and, once closed, an index of the records' offsets and timestamps. the header's index
+    offset is zero until then, so a recording that was never closed can still be read by stepping
+    through the records.
+    """
+    MAGIC = b'WLRC'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHHHQQ') # magic, version, rows, cols, 0, num frames, index offset
+    HEADER_SIZE = 32
+    TIMESTAMP = struct.Struct('<d')
+    INDEX_DTYPE = np.dtype([('offset', '<u8'), ('t', '<f8')])
+
+    def __init__(self, driver, path):
+        self._driver = driver
+        self._path = path
+        self._file = open(path, 'wb')
+        self._index = []
+        self._t0 = None
+        self._write_header(0)
+        log.info('recording {}x{} frames to {}'.format(*reversed(driver.dim()), path))
+
+    def set(self, matrix):
+        # the driver validates the frame, so only frames it accepted are recorded
+        self._driver.set(matrix)
+        now = time.perf_counter()
+        if self._t0 is None:
+            self._t0 = now
+        t = now - self._t0
+        self._index.append((self._file.tell(), t))
+        self._file.write(self.TIMESTAMP.pack(t))
+        self._file.write(frame_to_uint8(matrix).tobytes())
+
+    def get(self):
+        return self._driver.get()
+
+    def dim(self):
+        return self._driver.dim()
+
+    def close(self):
+        if self._file is None:
+            return
+        index_offset = self._file.tell()
+        self._file.write(np.array(self._index, dtype=self.INDEX_DTYPE).tobytes())
+        self._file.seek(0)
+        self._write_header(index_offset)
+        self._file.close()
+        self._file = None
+        log.info('recorded {} frames to {}'.format(len(self._index), self._path))
+
+    def _write_header(self, index_offset):
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, *self._driver.dim(), 0,
+                                  len(self._index), index_offset)
+        self._file.write(header.ljust(self.HEADER_SIZE, b'\0'))
+
+class FrameRecording:
+    """
+    a recording made by RecordingDisplay, memory-mapped. frames are uint8 ndarray views straight
+    into the mapping, so reading one decodes and copies nothing.
+    """
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, num_rows, num_cols, _, num_frames, index_offset = \
+                RecordingDisplay.HEADER.unpack_from(self._mmap)
+        if magic != RecordingDisplay.MAGIC or version != RecordingDisplay.VERSION:
+            raise RuntimeError('{} is not a version {} recording'.format(path,
+                                                                         RecordingDisplay.VERSION))
+        self._dim = (num_rows, num_cols)
+        frame_size = num_rows * num_cols * 3
+        if index_offset:
+            index = np.frombuffer(self._mmap, dtype=RecordingDisplay.INDEX_DTYPE, count=num_frames,
+                                  offset=index_offset)
+            self._offsets = index['offset'] + RecordingDisplay.TIMESTAMP.size
+            self._times = index['t']
+        else:
+            # never closed. step through whatever complete records made it to the file.
+            record_size = RecordingDisplay.TIMESTAMP.size + frame_size
+            num_frames = (len(self._mmap) - RecordingDisplay.HEADER_SIZE) // record_size
+            offsets = RecordingDisplay.HEADER_SIZE + record_size * np.arange(num_frames)
+            self._offsets = offsets + RecordingDisplay.TIMESTAMP.size
+            self._times = np.array([RecordingDisplay.TIMESTAMP.unpack_from(self._mmap, offset)[0]
+                                    for offset in offsets])
+            log.warning('{} was not closed, recovered {} frames'.format(path, num_frames))
+        self._frame_size = frame_size
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def dim(self):
+        return tuple(self._dim)
+
+    def time(self, i):
+        # seconds since the first frame
+        return float(self._times[i])
+
+    def frame(self, i):
+        return np.frombuffer(self._mmap, dtype=np.uint8, count=self._frame_size,
+                             offset=int(self._offsets[i])).reshape(*self._dim, 3)
+
+    def play(self, driver, rate=1., loop=False):
+        """
+        sets the frames on driver at their recorded times, scaled by rate (2 plays twice as fast)
+        """
+        assert rate > 0
+        assert driver.dim() == self._dim, 'recording is {}x{}'.format(*reversed(self._dim))
+        while True:
+            start = time.perf_counter()
+            for i in range(len(self)):
+                wait = start + self._times[i] / rate - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                driver.set(self.frame(i))
+            if not loop or not len(self):
+                return
+
+    def close(self):
+        # frames still referencing the mapping keep it alive
+        self._file.close()
+
 class FakeDisplay:
     def __init__(self, num_rows=DEFAULT_NUM_ROWS, num_cols=DEFAULT_NUM_COLS):
         log.info('using fake {}x{} display'.format(num_cols, num_rows))
@@ -186,8 +1218,9 @@ class FakeDisplay:
     def set(self, matrix):
         # note: it's important that _current_matrix becomes a copy here. store it before gamma
         # correction.
-        assert _get_dim(matrix) == self._dim
-        self._current_matrix = copy.deepcopy(matrix)
+        frame = copy_frame(matrix)
+        assert frame.shape[:2] == self._dim
+        self._current_matrix = frame_to_float(frame)
 
     def get(self):
         return self._current_matrix
@@ -195,19 +1228,112 @@ class FakeDisplay:
     def dim(self):
         return tuple(self._dim)
 
+class FakeSpiDev:
+    """
+    stands in for spidev.SpiDev, e.g. to exercise LocalLedDisplay without hardware. the last write is
+    kept, and if simulate_timing is set, writes take as long as they would on a real bus at
+    max_speed_hz.
+    """
+    def __init__(self, simulate_timing=False):
+        self.lsbfirst = False
+        self.max_speed_hz = 500000
+        self.mode = 0b00
+        self.bus = None
+        self.index = None
+        self.num_writes = 0
+        self.last_write = None
+        self._simulate_timing = simulate_timing
+
+    def open(self, bus, index):
+        self.bus = bus
+        self.index = index
+
+    def close(self):
+        pass
+
+    def xfer(self, data):
+        self.writebytes2(data)
+        return [0] * len(data)
+
+    def writebytes2(self, data):
+        self.last_write = bytes(data)
+        self.num_writes += 1
+        if self._simulate_timing:
+            time.sleep(8 * len(self.last_write) / self.max_speed_hz)
+
 class LocalLedDisplay:
-    def __init__(self, gamma_correct=True, bus=0, index=0, num_rows=DEFAULT_NUM_ROWS, num_cols=DEFAULT_NUM_COLS, sclk_hz=500000):
+    GAMMA = 2.3
+    WIRINGS = ('snake', 'progressive')
+    FIRST_ROWS = ('bottom', 'top')
+
+    # float channels are quantized to this many levels before the gamma table lookup. 12 bits keeps
+    # the table small while still resolving the dim end of the gamma curve.
+    FLOAT_LUT_SIZE = 4096
+
+    # the spidev driver rejects transfers larger than its bufsiz module parameter
+    SPIDEV_BUFSIZ_PATH = '/sys/module/spidev/parameters/bufsiz'
+    DEFAULT_SPIDEV_BUFSIZ = 4096
+
+    def __init__(self, gamma_correct=True, bus=0, index=0, num_rows=DEFAULT_NUM_ROWS,
+                 num_cols=DEFAULT_NUM_COLS, sclk_hz=500000, wiring='snake', first_row='bottom',
+                 rotation=0, asynchronous=True, max_refresh_hz=None, spi=None, chains=None,
+                 max_transfer_size=None):
         """
         note: for reference, 100 LEDs can be physically updated in ~0.01 seconds at ~250 khz. note
         that occasional glitching was observed on the real display at 1 mhz.
+
+        when asynchronous, set() only hands the frame to a background writer thread, so callers
+        never wait on the bus. the writer always writes the latest frame: frames set while another
+        is still pending supersede it. max_refresh_hz optionally caps how often the bus is written.
+        the last frame is flushed by close(), which also runs at exit.
+
+        spi may be an already-constructed spidev.SpiDev stand-in, e.g. FakeSpiDev, or a list of them
+        (one per chain).
+
+        frames are written straight from a reused buffer with writebytes2, in transfers of at most
+        max_transfer_size bytes (by default, the spidev driver's bufsiz). the LEDs latch after the
+        clock idles for a while (500 us for WS2801), so the gaps between transfers must stay under
+        that, which they comfortably do at spidev's default 4 KiB.
+
+        large walls can be split into several chains, given as (bus, index) pairs. the chain order
+        (see below) is cut into equal consecutive runs of pixels, the first run going to the first
+        chain and so on, as if one long chain were cut into pieces each fed from its own chip
+        select. the chains are written in parallel. note that chip selects on the same bus still
+        share its controller, so only chains on different buses actually transfer concurrently.
+
+        the physical chain layout is described by:
+
+            * wiring: 'snake' chains reverse direction every row, 'progressive' chains always run
+              left to right
+            * first_row: whether the chain starts at the 'bottom' or 'top' row
+            * rotation: clockwise rotation in degrees that takes the logical frame to the physical
+              panel
+
+        the defaults match the original 10x10 wall, which is a snake wired from the bottom row.
         """
-        log.info('using {}x{} display on spi {}:{} at {} khz'.format(num_cols, num_rows, bus,
-                index, sclk_hz / 1e3))
-        self._spi = spidev.SpiDev()
-        self._spi.open(bus, index)
-        self._spi.lsbfirst = False
-        self._spi.max_speed_hz = sclk_hz
-        self._spi.mode = 0b00
+        assert wiring in self.WIRINGS
+        assert first_row in self.FIRST_ROWS
+        assert rotation in (0, 90, 180, 270)
+        chains = [(bus, index)] if chains is None else [tuple(chain) for chain in chains]
+        assert 0 < len(chains) <= num_rows * num_cols
+        if spi is None:
+            spis = [spidev.SpiDev() for _ in chains]
+        elif isinstance(spi, (list, tuple)):
+            spis = list(spi)
+        else:
+            spis = [spi]
+        assert len(spis) == len(chains)
+        log.info('using {}x{} display on spi {} at {} khz ({} wiring from {}, rotated {})'.format(
+                num_cols, num_rows, '+'.join('{}:{}'.format(*chain) for chain in chains),
+                sclk_hz / 1e3, wiring, first_row, rotation))
+        for s, (chain_bus, chain_index) in zip(spis, chains):
+            s.open(chain_bus, chain_index)
+            s.lsbfirst = False
+            s.max_speed_hz = sclk_hz
+            s.mode = 0b00
+        self._spis = spis
+        self._max_transfer_size = max_transfer_size or self._spidev_bufsiz()
+        assert self._max_transfer_size > 0
 
         self._spi_xfer_profiler = IntervalProfiler('spi xfer', log)
 
@@ -217,18 +1343,67 @@ class LocalLedDisplay:
         if not self._gamma_correct:
             log.info('Note: not using gamma correction')
 
+        # everything that does not depend on the frame contents is computed once here, so encoding
+        # a frame is one gather plus one table lookup into a preallocated buffer
+        self._channel_order = self._chain_channel_order(num_rows, num_cols, wiring, first_row,
+                                                        rotation)
+        self._float_lut = self._build_lut(self.FLOAT_LUT_SIZE)
+        self._uint8_lut = self._build_lut(256)
+        self._tx_buf = bytearray(len(self._channel_order))
+        self._tx = np.frombuffer(self._tx_buf, dtype=np.uint8)
+
+        # each chain writes its run of the tx buffer through a view, so nothing is copied. all but
+        # the first chain are written from a pool while the writing thread does the first.
+        num_pixels = num_rows * num_cols
+        bounds = [3 * (num_pixels * i // len(spis)) for i in range(len(spis) + 1)]
+        self._chain_bufs = [memoryview(self._tx_buf)[start:end]
+                            for start, end in zip(bounds, bounds[1:])]
+        self._chain_pool = None
+        if len(spis) > 1:
+            self._chain_pool = concurrent.futures.ThreadPoolExecutor(len(spis) - 1,
+                                                                     thread_name_prefix='spi chain')
+
+        # the writer thread and set() hand frames over through a single pending slot, guarded by
+        # the condition. the tx buffer is only ever touched by whoever is writing.
+        assert max_refresh_hz is None or max_refresh_hz > 0
+        self._asynchronous = asynchronous
+        self._min_write_period = 1. / max_refresh_hz if max_refresh_hz else 0.
+        self._cond = threading.Condition()
+        self._pending_frame = None
+        self._writing = False
+        self._closed = False
+        self._last_write_t = None
+        self._num_frames_written = 0
+        self._num_frames_superseded = 0
+        self._writer = None
+        if self._asynchronous:
+            self._writer = threading.Thread(target=self._write_forever, name='spi writer',
+                                            daemon=True)
+            self._writer.start()
+            # the writer is a daemon thread, so without this a script that sets a frame and exits
+            # would lose it
+            atexit.register(self.close)
+
         self._current_matrix = None
         self.set(all_off_matrix(self.dim()))
 
     def set(self, matrix):
         # note: it's important that _current_matrix becomes a copy here. store it before gamma
         # correction.
-        assert _get_dim(matrix) == self._dim
-        self._current_matrix = copy.deepcopy(matrix)
-        with self._spi_xfer_profiler.measure():
-            if self._gamma_correct:
-                matrix = self._gamma_corrected(matrix)
-            self._spi.xfer(self._flatten(matrix))
+        frame = copy_frame(matrix)
+        assert frame.shape[:2] == self._dim
+        # checked here, on the caller's thread, rather than when the writer gets to the frame
+        assert _frame_in_range(frame), 'channel values out of bounds'
+        self._current_matrix = frame_to_float(frame)
+        if not self._asynchronous:
+            self._write(frame)
+            return
+        with self._cond:
+            assert not self._closed
+            if self._pending_frame is not None:
+                self._num_frames_superseded += 1
+            self._pending_frame = frame
+            self._cond.notify_all()
 
     def get(self):
         # TODO: Do-and-undo gamma correction so we see integer truncation in feedback
@@ -237,39 +1412,286 @@ class LocalLedDisplay:
     def dim(self):
         return tuple(self._dim)
 
-    def _gamma_corrected(self, matrix):
-        return [[tuple(ch ** 2.3 for ch in color) for color in row] for row in matrix]
+    def flush(self):
+        """
+        waits until the most recently set frame has been written
+        """
+        with self._cond:
+            while self._pending_frame is not None or self._writing:
+                self._cond.wait()
+
+    def close(self):
+        if self._writer is not None:
+            self.flush()
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            self._writer.join()
+            self._writer = None
+        if self._chain_pool is not None:
+            self._chain_pool.shutdown()
+            self._chain_pool = None
+
+    def num_frames_written(self):
+        return self._num_frames_written
+
+    def num_frames_superseded(self):
+        # frames that were replaced by a newer frame before the writer got to them
+        return self._num_frames_superseded
+
+    def _write(self, frame):
+        self._encode(frame)
+        with self._spi_xfer_profiler.measure():
+            if self._chain_pool is None:
+                self._write_chain(0)
+            else:
+                futures = [self._chain_pool.submit(self._write_chain, i)
+                           for i in range(1, len(self._spis))]
+                self._write_chain(0)
+                for future in futures:
+                    future.result()
+        self._last_write_t = time.perf_counter()
+        self._num_frames_written += 1
+
+    def _write_chain(self, i):
+        # writebytes2 takes any buffer and releases the GIL while writing. older spidev versions
+        # only have writebytes, which takes a list.
+        spi = self._spis[i]
+        buf = self._chain_bufs[i]
+        writebytes2 = getattr(spi, 'writebytes2', None)
+        for start in range(0, len(buf), self._max_transfer_size):
+            chunk = buf[start:start + self._max_transfer_size]
+            if writebytes2 is not None:
+                writebytes2(chunk)
+            else:
+                spi.writebytes(chunk.tolist())
+
+    @classmethod
+    def _spidev_bufsiz(cls):
+        try:
+            with open(cls.SPIDEV_BUFSIZ_PATH) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return cls.DEFAULT_SPIDEV_BUFSIZ
 
-    def _flatten(self, matrix):
-        # rows are physically wired low to high, so row order must be reversed. every other row must
-        # also be internally reversed to account for chain snaking.
-        snaked_rows = (row if i % 2 == 0 else reversed(row)
-                        for i, row in enumerate(reversed(matrix)))
-        flattened_rgb = [ch for row in snaked_rows for color in row for ch in color]
+    def _write_forever(self):
+        while True:
+            with self._cond:
+                while self._pending_frame is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+
+                # honor the refresh rate cap. frames set while waiting replace the pending frame, so
+                # whatever is latest when the wait is over gets written.
+                if self._last_write_t is not None:
+                    wait = self._last_write_t + self._min_write_period - time.perf_counter()
+                    while wait > 0 and not self._closed:
+                        self._cond.wait(wait)
+                        wait = self._last_write_t + self._min_write_period - time.perf_counter()
+
+                frame, self._pending_frame = self._pending_frame, None
+                self._writing = True
+            try:
+                self._write(frame)
+            except OSError as e:
+                log.error('spi write failed: {}'.format(e))
+            except Exception:
+                # the writer must outlive any one bad frame, or later frames would be silently
+                # dropped and flush() would wait forever
+                log.exception('spi write failed')
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    @staticmethod
+    def _chain_channel_order(num_rows, num_cols, wiring, first_row, rotation):
+        """
+        returns, for each byte in the chain, the index of the channel it shows in the flattened
+        logical frame
+        """
+        # lay the logical pixel indices out the way the panel physically sits, then walk its rows in
+        # chain order
+        pixels = np.arange(num_rows * num_cols).reshape(num_rows, num_cols)
+        pixels = np.rot90(pixels, -rotation // 90)
+        if first_row == 'bottom':
+            pixels = pixels[::-1]
+        pixels = pixels.copy()
+        if wiring == 'snake':
+            pixels[1::2] = pixels[1::2, ::-1]
+        return (3 * pixels.reshape(-1, 1) + np.arange(3)).ravel()
+
+    def _build_lut(self, size):
+        # maps quantized channel levels to gamma-corrected 8-bit values. the 8-bit conversion
+        # matches the original int(ch * 256) truncation, saturating at 255.
+        levels = np.linspace(0., 1., size)
+        if self._gamma_correct:
+            levels = levels ** self.GAMMA
+        return np.minimum(levels * 256, 255).astype(np.uint8)
+
+    def _encode(self, frame):
+        chs = frame.reshape(-1)[self._channel_order]
+        if frame.dtype == np.float32:
+            # set() checked the channels are in [0, 1], so every index is in the table. np.take
+            # would raise for indices past the end but wrap negative ones around.
+            lut = self._float_lut
+            chs = (chs * (len(lut) - 1) + 0.5).astype(np.intp)
+        else:
+            lut = self._uint8_lut
+        np.take(lut, chs, out=self._tx)
+        return self._tx_buf
 
-        # convert to 8-bit channels, but verify ranges first
-        assert all(ch >= 0 and ch <= 1.0 for ch in flattened_rgb)
-        flattened_rgb8 = [min(int(ch * 256), 255) for ch in flattened_rgb]
+class _RttEstimator:
+    """
+    smoothed round trip time and retransmission timeout (RTO), computed like TCP's (RFC 6298). the
+    RTO doubles on each timeout until a fresh sample comes in.
+    """
+    ALPHA = 1. / 8
+    BETA = 1. / 4
+    K = 4
+
+    def __init__(self, initial_rto, min_rto, max_rto):
+        assert 0 < min_rto <= max_rto
+        self._min_rto = min_rto
+        self._max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.rto = min(max(initial_rto, min_rto), max_rto)
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = min(max(self.srtt + self.K * self.rttvar, self._min_rto), self._max_rto)
+
+    def backoff(self):
+        self.rto = min(2 * self.rto, self._max_rto)
 
-        assert len(flattened_rgb8) == 3 * self._dim[0] * self._dim[1]
-        return flattened_rgb8
+class _ClockOffsetEstimator:
+    """
+    estimates the offset from the local time.time() clock to the server's, NTP style: an
+    ack timestamped by the server at some point during the round trip puts the server's clock at
+    its timestamp at about the round trip's midpoint. the error is at most half the round trip, so
+    the sample with the shortest round trip among the recent ones is used.
+    """
+    def __init__(self, num_samples=16):
+        self._samples = [] # (rtt, offset)
+        self._num_samples = num_samples
+
+    def sample(self, send_t, recv_t, server_t):
+        self._samples.append((recv_t - send_t, server_t - (send_t + recv_t) / 2))
+        del self._samples[:-self._num_samples]
+
+    def offset(self):
+        # local time + offset = server time. None until there is a sample.
+        return min(self._samples)[1] if self._samples else None
 
 class UdpLedDisplay:
+    # acks are only read when the client gets around to it (e.g. at the next set() in asynchronous
+    # mode), and only those read within this long of when they could have arrived are used for RTT
+    # and clock samples
+    MAX_ACK_READ_DELAY = 0.001
+    # when acks are mostly read late, set() waits for one about this often (in seconds) to keep the
+    # samples fresh
+    PROBE_INTERVAL = 1.
+
     def __init__(self, host, port=DEFAULT_UDP_SERVER_PORT, num_rows=DEFAULT_NUM_ROWS,
-                 num_cols=DEFAULT_NUM_COLS, synchronous=False, timeout=0.1):
+                 num_cols=DEFAULT_NUM_COLS, synchronous=False, timeout=0.1,
+                 protocol=DEFAULT_PROTOCOL, channel_bits=8,
+                 max_datagram_size=DEFAULT_MAX_DATAGRAM_SIZE, delta=False,
+                 keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, ack_only=True, window=None,
+                 adaptive_timeout=True, min_timeout=0.01, max_timeout=1., max_retries=2,
+                 presentation_delay=None):
         """
         relatively long timeout gives the servers's buffers a break if they are falling behind
+
+        with adaptive_timeout, timeout is only the starting point: the ack timeout tracks the
+        measured round trip time like TCP's retransmission timeout, within [min_timeout,
+        max_timeout], and backs off exponentially while acks are being missed. get() retries up to
+        max_retries times. frames are not retried by set(), since the next set() supersedes them,
+        but in windowed mode the newest frame is resent (up to max_retries times) if it is lost and
+        nothing newer has been set since.
+
+        protocol v1 sends 32-bit float channels in a single datagram, which limits frames to ~340
+        pixels. v2 sends 8- or 16-bit channels (channel_bits), fragmented to max_datagram_size.
+
+        in delta mode (v2 only), frames are sent as the pixels that changed since the last keyframe
+        the server acknowledged. deltas are always against an acknowledged keyframe rather than the
+        previous frame, so a lost delta never corrupts the ones after it. a new keyframe is sent
+        every keyframe_interval frames, whenever a delta would not be smaller, after a timeout, and
+        when the server reports it does not have the reference.
+
+        set() never looks at the frame the server echoes back, so with ack_only (v2 only) updates
+        are acknowledged with a bare header instead. get() queries always receive the frame.
+
+        with a window, set() pipelines frames: it mostly doesn't wait for a frame's own ack, but
+        acks are still matched against the frames in flight as they come in, giving a loss count,
+        and per-frame RTTs for acks read as soon as they arrive. once window frames are in flight,
+        set() blocks until one is acknowledged or times out; window_full() lets render loops see
+        this coming and back off instead. with adaptive_timeout, set() also waits for its frame's
+        ack about once every PROBE_INTERVAL seconds, so the RTT stays fresh even when acks are
+        only read at the next set().
+
+        with a presentation_delay (v2 only), frames are stamped to be shown that many seconds after
+        they are set, on the server's clock. the server buffers them and shows each at its time, so
+        network jitter smaller than the delay never reaches the wall, while frames that arrive
+        after their time are dropped. the offset to the server's clock is estimated from the acks
+        read as soon as they arrive (set() waits for one about once every PROBE_INTERVAL seconds),
+        and until there is an estimate frames are shown as soon as they arrive.
         """
-        log.info('using {}x{} display at {}:{}'.format(num_cols, num_rows, host, port))
+        assert protocol in (PROTOCOL_V1, PROTOCOL_V2)
+        assert window is None or (window > 0 and not synchronous)
+        assert channel_bits in _V2_CHANNEL_DTYPES
+        assert not delta or protocol == PROTOCOL_V2
+        assert keyframe_interval > 0
+        assert presentation_delay is None or (presentation_delay >= 0 and protocol == PROTOCOL_V2)
+        log.info('using {}x{} display at {}:{} (protocol v{})'.format(num_cols, num_rows, host, port,
+                                                                      protocol))
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._host = host
         self._port = port
         self._dim = (num_rows, num_cols)
         self._synchronous = synchronous
+        self._protocol = protocol
+        self._channel_bits = channel_bits
+        self._max_datagram_size = max_datagram_size
+        self._reassembler = _V2Reassembler()
+        self._ack_only = ack_only
+        self._delta = delta
+        self._keyframe_interval = keyframe_interval
+        self._keyframe = None # (msg_seq, quantized channels) of the last acknowledged keyframe
+        self._pending_keyframes = {} # msg_seq -> quantized channels
+        self._frames_since_keyframe = 0
+        self._window = window
+        self._in_flight = {} # msg_seq -> send time, oldest first
+        self._rx_idle_t = None # when the socket was last seen without pending acks
+        self._probe_t = None # when set() last waited for an ack to take samples from
+        self._num_lost = 0
+        self._adaptive_timeout = adaptive_timeout
+        self._rtt = _RttEstimator(timeout, min_timeout, max_timeout) if adaptive_timeout else \
+                    _RttEstimator(timeout, timeout, timeout)
         self._timeout = timeout
+        self._max_timeout = max_timeout
+        self._max_retries = max_retries
+        self._last_frame_seq = None
+        self._last_frame_datagrams = None
+        self._last_frame_retries = 0
         self._msg_seq = 0
         self._num_total_timeouts = 0
-
+        self._last_ack_flags = 0
+        self._presentation_delay = presentation_delay
+        self._clock = _ClockOffsetEstimator()
+        self._clock_probes = {} # msg_seq -> send time, of requests asking for the server's clock
+        self._frame_t = None # when to show the frame being set, instead of after the delay
+
+        self._rtt_stats = Stats('display ack rtt', log)
+        self._rto_stats = Stats('display ack timeout', log)
+        self._retry_stats = Stats('display get retries', log)
+        self._in_flight_stats = Stats('display frames in flight', log)
         self._set_period_profiler = PeriodProfiler('display set', log)
         self._get_period_profiler = PeriodProfiler('display get', log)
         self._get_time_profiler = IntervalProfiler('display set', log)
@@ -279,12 +1701,152 @@ class UdpLedDisplay:
 
     def set(self, matrix):
         self._set_period_profiler.mark()
-        self._request(matrix, self._synchronous)
+        self._request(as_frame(matrix), self._synchronous or self._probe_due())
+        if self._window is not None:
+            self._in_flight_stats.sample(len(self._in_flight))
+            self._wait_for_window()
+
+    def window_full(self):
+        """
+        backpressure signal: True if the next set() would block waiting for frames in flight
+        """
+        if self._window is None:
+            return False
+        self._drain_acks()
+        return len(self._in_flight) >= self._window
+
+    def num_in_flight(self):
+        return len(self._in_flight)
+
+    def num_lost(self):
+        # windowed frames that were never acknowledged
+        return self._num_lost
 
     def get(self):
         self._get_period_profiler.mark()
         with self._get_time_profiler.measure():
-            return self._request(None, True)
+            # the backed-off timeout carries over between calls, so bound the whole query by the
+            # budget it would have had with the initial timeout
+            deadline = time.perf_counter() + self._timeout * (self._max_retries + 1)
+            num_attempts = 0
+            while num_attempts <= self._max_retries:
+                time_left = deadline - time.perf_counter()
+                if time_left <= 0:
+                    break
+                num_attempts += 1
+                try:
+                    ack_matrix = self._request_impl(None, True, timeout=min(self._rtt.rto, time_left))
+                    self._retry_stats.sample(num_attempts - 1)
+                    return ack_matrix
+                except TimeoutError as e:
+                    self._rtt.backoff()
+                    log.debug('retrying display query: {}'.format(e))
+            self._retry_stats.sample(num_attempts - 1)
+            self._num_total_timeouts += 1
+            log.warning('timeout querying display after {} attempts'.format(num_attempts))
+            return None
+
+    def set_many(self, frames, frame_period, loop=False):
+        """
+        uploads the frames as a clip for the server to play by itself, one every frame_period
+        seconds, and starts playing it. clips are kept in a bounded store on the server, so they
+        can be played again later with play_clip() without uploading them again. a set() stops the
+        clip. clips bigger than 64 KiB are uploaded in parts, each acknowledged before the next is
+        sent, and acks for the clip (parts) are waited for up to max_timeout. returns the clip id,
+        or None if the upload timed out (v2 only).
+        """
+        assert self._protocol == PROTOCOL_V2
+        assert frame_period > 0
+        frames = [as_frame(frame) for frame in frames]
+        assert frames and all(_get_dim(frame) == self._dim for frame in frames)
+        clip_id, body = _encode_v2_clip(frames, frame_period, self._channel_bits)
+        # the RTO is sized for single frames, while a clip (part) can take far longer to get across
+        # and be reassembled, so its ack is waited for up to max_timeout
+        timeout = max(self._rtt.rto, self._max_timeout)
+        if len(body) <= _V2_CLIP_PART_SIZE:
+            uploaded = self._command(_V2_ENCODING_CLIP, body, self._dim, timeout)
+        else:
+            # big clips go in parts, one at a time, so the server's buffers never overflow
+            uploaded = all(self._command(_V2_ENCODING_CLIP_PART,
+                                         _V2_CLIP_PART.pack(clip_id, offset, len(body)) +
+                                         body[offset:offset + _V2_CLIP_PART_SIZE], self._dim,
+                                         timeout)
+                           for offset in range(0, len(body), _V2_CLIP_PART_SIZE))
+        if not uploaded:
+            log.warning('timeout uploading clip {:08x}'.format(clip_id))
+            return None
+        return clip_id if self.play_clip(clip_id, loop) else None
+
+    def play_clip(self, clip_id, loop=False):
+        """
+        plays a clip uploaded earlier with set_many(). returns False if the server doesn't have it
+        (any more) or didn't answer.
+        """
+        assert self._protocol == PROTOCOL_V2
+        if not self._command(_V2_ENCODING_CLIP_PLAY, _V2_CLIP_PLAY.pack(clip_id, loop), (0, 0)):
+            log.warning('timeout playing clip {:08x}'.format(clip_id))
+            return False
+        if self._last_ack_flags & _V2_FLAG_NEED_CLIP:
+            log.info('display does not have clip {:08x}'.format(clip_id))
+            return False
+        return True
+
+    def _command(self, encoding, body, dim, timeout=None):
+        # sends a v2 message that must be acknowledged, retrying like get(). returns whether it was.
+        # each attempt waits timeout for the ack, or the RTO by default.
+        def pack(_, msg_seq):
+            return _fragment_v2(body, msg_seq, encoding, self._channel_bits, dim,
+                                _V2_FLAG_ACK_ONLY, self._max_datagram_size)
+        for num_retries in range(self._max_retries + 1):
+            try:
+                self._request_impl(None, True, pack, timeout)
+                return True
+            except TimeoutError as e:
+                self._rtt.backoff()
+                log.debug('retrying display command: {}'.format(e))
+        self._num_total_timeouts += 1
+        return False
+
+    def rtt(self):
+        # smoothed round trip time, or None if nothing has been acknowledged yet
+        return self._rtt.srtt
+
+    def rtt_stats(self):
+        # the Stats of every RTT sample
+        return self._rtt_stats
+
+    def num_timeouts(self):
+        # requests (or, in get() and commands, all of their retries) that were never acknowledged
+        return self._num_total_timeouts
+
+    def ack_timeout(self):
+        return self._rtt.rto
+
+    def clock_offset(self):
+        # estimated server clock minus local clock, with a presentation_delay. None until known.
+        return self._clock.offset()
+
+    def _probe_due(self):
+        # asynchronous acks are only read promptly while the window is full, so at lower frame
+        # rates set() now and then waits for its frame's ack to keep the RTT and clock offset fresh
+        if self._presentation_delay is None and (self._window is None or
+                                                 not self._adaptive_timeout):
+            return False
+        now = time.perf_counter()
+        if self._probe_t is not None and now - self._probe_t < self.PROBE_INTERVAL:
+            return False
+        self._probe_t = now
+        return True
+
+    def _set_frame(self, matrix, msg_seq, frame_t):
+        # set() with the given msg_seq, to be shown at frame_t on the local time.time() clock
+        # (given a presentation_delay). lets GroupLedDisplay keep its walls in step.
+        self._msg_seq = msg_seq
+        self._frame_t = frame_t
+        try:
+            self.set(matrix)
+        finally:
+            self._frame_t = None
 
     def _request(self, matrix, wait_for_ack):
         try:
@@ -292,156 +1854,1199 @@ class UdpLedDisplay:
             return ack_matrix
         except TimeoutError as e:
             self._num_total_timeouts += 1
+            self._rtt.backoff()
             log.warning('timeout requesting display: {}'.format(e))
+            # something is being lost, so make sure the next frame stands on its own
+            self._frames_since_keyframe = self._keyframe_interval
 
         return None
 
-    def _request_impl(self, matrix, wait_for_ack):
+    def _request_impl(self, matrix, wait_for_ack, pack=None, timeout=None):
         # sanity-check the matrix (if any) has expected dimensions
         assert matrix is None or _get_dim(matrix) == self._dim
 
+        # acks already waiting were not read promptly, so get them out of the way of the wait below
+        if wait_for_ack:
+            self._drain_acks()
+
         # send the data
         tx_msg_seq =  self._msg_seq
         self._msg_seq = (self._msg_seq + 1) % 2**32
-        tx = _pack_udp(matrix, tx_msg_seq)
-        self.socket.sendto(tx, (self._host, self._port))
+        datagrams = (pack or self._pack)(matrix, tx_msg_seq)
+        for tx in datagrams:
+            self.socket.sendto(tx, (self._host, self._port))
+        if self._window is not None and matrix is not None:
+            # a frame that is waited for (a timing probe) isn't tracked in flight, but still
+            # supersedes the frames before it, so they are never resent after it
+            if not wait_for_ack:
+                self._in_flight[tx_msg_seq] = time.perf_counter()
+            self._last_frame_seq = tx_msg_seq
+            self._last_frame_datagrams = datagrams
+            self._last_frame_retries = 0
 
         # wait for acknowledgement if requested. otherwise, flush the socket RX queue just to be
         # polite to the OS buffers
         if wait_for_ack:
-            start_t = time.time()
-            time_left = self._timeout
+            start_t = time.perf_counter()
+            timeout = self._rtt.rto if timeout is None else timeout
+            time_left = timeout
             while time_left >= 0:
                 readers, _, _ = select.select([self.socket], [], [], time_left)
                 if self.socket in readers:
-                    rx, _ = self.socket.recvfrom(4096) # should return immediately
+                    rx, _ = self.socket.recvfrom(_MAX_RECV_SIZE) # should return immediately
+                    self._rx_idle_t = time.perf_counter()
                     try:
                         # the request is considered acknowledged if the sequence numbers match. don't
                         # bother verifying dimensions or contents, this may not apply (e.g., if this is
                         # query-only)
-                        rx_matrix, rx_msg_seq = _unpack_udp(rx)
-                        if rx_msg_seq == tx_msg_seq:
-                            return rx_matrix
-                    except RuntimeError as e:
+                        ack = self._unpack_ack(rx, prompt=True)
+                        if ack is not None:
+                            rx_matrix, rx_msg_seq = ack
+                            if rx_msg_seq == tx_msg_seq:
+                                self._sample_rtt(time.perf_counter() - start_t)
+                                return rx_matrix
+                    except RuntimeError:
                         pass
-                time_left = self._timeout - (time.time() - start_t)
+                time_left = timeout - (time.perf_counter() - start_t)
 
             # no acknowledgement in time
             raise TimeoutError('response timeout for msg {}'.format(tx_msg_seq))
         else:
-            num_flushed = 0
-            while num_flushed < 10:
-                readers, _, _ = select.select([self.socket], [], [], 0)
-                if not readers:
-                    break
-                self.socket.recvfrom(4096) # should return immediately
-                num_flushed += 1
+            self._drain_acks()
             return None
 
-class _UdpLedDisplayServer:
+    def _drain_acks(self):
+        # in plain asynchronous mode acks are just flushed, but the window and keyframe tracking
+        # need every one of them
+        track = self._window is not None or self._delta or self._presentation_delay is not None
+        # acks read now arrived some time since the socket was last seen idle
+        prompt = self._rx_idle_t is not None and \
+                 time.perf_counter() - self._rx_idle_t <= self.MAX_ACK_READ_DELAY
+        num_flushed = 0
+        while num_flushed < (1000 if track else 10):
+            readers, _, _ = select.select([self.socket], [], [], 0)
+            if not readers:
+                self._rx_idle_t = time.perf_counter()
+                break
+            rx, _ = self.socket.recvfrom(_MAX_RECV_SIZE) # should return immediately
+            num_flushed += 1
+            if track:
+                try:
+                    self._unpack_ack(rx, decode=False, prompt=prompt)
+                except RuntimeError:
+                    pass
+        self._expire_in_flight()
+
+    def _sample_rtt(self, rtt):
+        self._rtt_stats.sample(rtt)
+        if self._adaptive_timeout:
+            self._rtt.sample(rtt)
+            self._rto_stats.sample(self._rtt.rto)
+
+    def _expire_in_flight(self):
+        # frames in flight longer than the timeout are considered lost. they are all judged against
+        # the same timeout, and one stall backs it off once however many frames it took with it
+        # (like RFC 6298).
+        now = time.perf_counter()
+        rto = self._rtt.rto
+        expired = list(itertools.takewhile(lambda item: now - item[1] > rto,
+                                           self._in_flight.items()))
+        if expired:
+            self._rtt.backoff()
+        for msg_seq, _ in expired:
+            del self._in_flight[msg_seq]
+
+            # a lost frame is stale once a newer one has been sent, but the newest frame is worth
+            # sending again. it keeps its msg_seq, so its ack does not yield an RTT sample (like
+            # Karn's algorithm).
+            if msg_seq == self._last_frame_seq and self._last_frame_retries < self._max_retries:
+                log.debug('display msg {} lost, resending'.format(msg_seq))
+                self._last_frame_retries += 1
+                for tx in self._last_frame_datagrams:
+                    self.socket.sendto(tx, (self._host, self._port))
+                self._in_flight[msg_seq] = now
+                continue
+
+            self._num_lost += 1
+            log.debug('display msg {} lost'.format(msg_seq))
+            # make sure the next frame stands on its own
+            self._frames_since_keyframe = self._keyframe_interval
+
+    def _wait_for_window(self):
+        while len(self._in_flight) >= self._window:
+            oldest_t = next(iter(self._in_flight.values()))
+            time_left = oldest_t + self._rtt.rto - time.perf_counter()
+            if time_left > 0:
+                readers, _, _ = select.select([self.socket], [], [], time_left)
+                if readers:
+                    # the socket was drained before waiting, so whatever is pending just arrived
+                    self._rx_idle_t = time.perf_counter()
+            self._drain_acks()
+
+    def _pack(self, matrix, msg_seq):
+        if self._protocol == PROTOCOL_V1:
+            return [_pack_udp(matrix, msg_seq)]
+        ack_flags = _V2_FLAG_ACK_ONLY if self._ack_only else 0
+        if matrix is None:
+            return _pack_v2(None, msg_seq, self._channel_bits,
+                            max_datagram_size=self._max_datagram_size)
+        if not self._delta:
+            frame = as_frame(matrix)
+            return self._fragment(_encode_v2_frame(frame, self._channel_bits), msg_seq,
+                                  _V2_ENCODING_FULL, frame.shape[:2], ack_flags)
+
+        chs = _quantize_v2(matrix, self._channel_bits)
+        encoded = None
+        if self._keyframe is not None and self._frames_since_keyframe < self._keyframe_interval:
+            encoded = _encode_v2_delta(chs, self._keyframe[1], self._keyframe[0],
+                                       self._channel_bits)
+        if encoded is not None:
+            encoding, body = encoded
+            flags = 0
+            self._frames_since_keyframe += 1
+        else:
+            # send a keyframe, and hold on to it until the server acknowledges it. the quantized
+            # channels may alias the caller's frame, so keep a copy.
+            encoding = _V2_ENCODING_FULL
+            body = chs.astype(_V2_CHANNEL_DTYPES[self._channel_bits], copy=False).tobytes()
+            flags = _V2_FLAG_KEYFRAME
+            self._pending_keyframes[msg_seq] = chs.copy()
+            while len(self._pending_keyframes) > 8:
+                del self._pending_keyframes[next(iter(self._pending_keyframes))]
+            self._frames_since_keyframe = 0
+        return self._fragment(body, msg_seq, encoding, chs.shape[:2], flags | ack_flags)
+
+    def _fragment(self, body, msg_seq, encoding, dim, flags):
+        # frames get their presentation time here, and ask for the server's clock to keep the
+        # estimate of its offset fresh
+        if self._presentation_delay is not None:
+            now = time.time()
+            flags |= _V2_FLAG_CLOCK
+            self._clock_probes[msg_seq] = now
+            while len(self._clock_probes) > 64:
+                del self._clock_probes[next(iter(self._clock_probes))]
+            offset = self._clock.offset()
+            if offset is not None:
+                flags |= _V2_FLAG_TIMESTAMP
+                frame_t = now + self._presentation_delay if self._frame_t is None else \
+                          self._frame_t
+                body = _V2_TIMESTAMP.pack(frame_t + offset) + body
+        return _fragment_v2(body, msg_seq, encoding, self._channel_bits, dim, flags,
+                            self._max_datagram_size)
+
+    def _on_ack(self, msg_seq, flags, timestamp=None, prompt=False):
+        # prompt: whether the ack was read as soon as it arrived, so its timing can be trusted
+        self._last_ack_flags = flags
+        probe_t = self._clock_probes.pop(msg_seq, None)
+        if timestamp is not None and probe_t is not None and prompt:
+            self._clock.sample(probe_t, time.time(), timestamp)
+        sent_t = self._in_flight.pop(msg_seq, None)
+        if sent_t is not None and prompt and not (msg_seq == self._last_frame_seq and
+                                                  self._last_frame_retries):
+            self._sample_rtt(time.perf_counter() - sent_t)
+
+        if not self._delta:
+            return
+        if flags & _V2_FLAG_NEED_KEYFRAME:
+            log.info('display lost delta reference, sending keyframe')
+            self._keyframe = None
+            self._frames_since_keyframe = self._keyframe_interval
+        else:
+            chs = self._pending_keyframes.pop(msg_seq, None)
+            if chs is not None:
+                self._keyframe = (msg_seq, chs)
+
+    def _unpack_ack(self, data, decode=True, prompt=False):
+        # returns (matrix, msg_seq), or None while a fragmented ack is still incomplete
+        if not _is_v2(data):
+            ack = _unpack_udp(data)
+            self._on_ack(ack[1], 0, prompt=prompt)
+            return ack
+        message = self._reassembler.add(None, data)
+        if message is None:
+            return None
+        self._on_ack(message.msg_seq, message.flags, message.timestamp, prompt)
+        if decode and message.encoding == _V2_ENCODING_FULL:
+            # get() always returns float frames, regardless of the wire format
+            return frame_to_float(_decode_v2_frame(message)), message.msg_seq
+        return None, message.msg_seq
+
+class GroupLedDisplay:
     """
-    This was originally implemented as a synchronous socketserver.UDPServer, but became concerned
-    about requests backing up in OS buffers. This version only serves the most recent request in the
-    RX buffers.
+    drives several walls as one display. frames are split into a grid of equal tiles, one per
+    wall, laid out row-major with grid_cols walls to a row (all of them in one row by default).
+    each wall gets its own UdpLedDisplay (addrs are (host, port) pairs, and options are passed
+    through), but every tile of a frame is sent with the same msg_seq and presentation time, mapped
+    onto each server's clock, so the walls flip together instead of drifting apart.
+
+    an address may be a multicast group, for walls that mirror the same tile: every server
+    listening on the group (--listen group:port) receives the tile, which is still only serialized
+    and sent once.
     """
-    def __init__(self, host_port, driver):
+    def __init__(self, addrs, num_rows=DEFAULT_NUM_ROWS, num_cols=DEFAULT_NUM_COLS, grid_cols=None,
+                 presentation_delay=0.05, **options):
+        grid_cols = grid_cols or len(addrs)
+        assert addrs and len(addrs) % grid_cols == 0
+        self._tile_dim = (num_rows, num_cols)
+        self._grid_dim = (len(addrs) // grid_cols, grid_cols)
+        self._presentation_delay = presentation_delay
+        self._tiles = [UdpLedDisplay(host, port, num_rows, num_cols, protocol=PROTOCOL_V2,
+                                     presentation_delay=presentation_delay, **options)
+                       for host, port in addrs]
+        log.info('using {}x{} group of {}x{} walls'.format(*reversed(self._grid_dim),
+                                                           *reversed(self._tile_dim)))
+
+    def dim(self):
+        return self._tile_dim[0] * self._grid_dim[0], self._tile_dim[1] * self._grid_dim[1]
+
+    def set(self, matrix):
+        frame = as_frame(matrix)
+        assert _get_dim(frame) == self.dim()
+        # a msg_seq none of the walls has used yet, and one local time to show the frame at
+        msg_seq = max(tile._msg_seq for tile in self._tiles)
+        frame_t = time.time() + self._presentation_delay
+        for tile, (rows, cols) in zip(self._tiles, self._tile_slices()):
+            tile._set_frame(frame[rows, cols], msg_seq, frame_t)
+
+    def get(self):
+        # the walls' frames put back together, or None if any of them didn't answer
+        frame = all_off_matrix(self.dim())
+        for tile, (rows, cols) in zip(self._tiles, self._tile_slices()):
+            tile_frame = tile.get()
+            if tile_frame is None:
+                return None
+            frame[rows, cols] = tile_frame
+        return frame
+
+    def window_full(self):
+        return any([tile.window_full() for tile in self._tiles])
+
+    def _tile_slices(self):
+        num_rows, num_cols = self._tile_dim
+        for i in range(len(self._tiles)):
+            row, col = divmod(i, self._grid_dim[1])
+            yield (slice(row * num_rows, (row + 1) * num_rows),
+                   slice(col * num_cols, (col + 1) * num_cols))
+
+_Request = namedtuple('_Request', 'client_addr matrix msg_seq version channel_bits flags '
+                                   'ack_flags sendto clip_play presentation_t',
+                      defaults=(None, None))
+
+# a clip stored on the server: its frames, one after the other every period seconds
+_Clip = namedtuple('_Clip', 'frames period size')
+
+_SharedMemoryAddr = namedtuple('_SharedMemoryAddr', 'name')
+
+class _SharedFrameRing:
+    """
+    the layout of the shared memory segment between SharedMemoryLedDisplay and
+    _SharedMemoryListener. all fields are native uint64s:
+
+        header: magic, version, rows, cols, num slots, frames published, 0, 0
+        state slot: seqlock, 0, 0, 0, then the float32 display state
+        frame slots: seqlock, frame number, dtype code, 0, then room for a float32 frame
+
+    there is a single writer per slot kind: the client publishes frames round-robin into the frame
+    slots and the server writes the state slot. each slot is guarded by a seqlock: the writer makes
+    its counter odd, writes, then makes it even again, and a reader retries if the counter was odd
+    or changed while it was copying.
+    """
+    MAGIC = 0x57414c4c45534d31 # 'WALLESM1'
+    VERSION = 1
+    DEFAULT_NUM_SLOTS = 4
+    HEADER_SIZE = 64
+    SLOT_HEADER_SIZE = 32
+    DTYPES = (np.dtype(np.float32), np.dtype(np.uint8))
+    MAX_READ_TRIES = 1000
+
+    @classmethod
+    def size(cls, dim, num_slots):
+        return cls.HEADER_SIZE + (num_slots + 1) * cls._slot_size(dim)
+
+    @classmethod
+    def _slot_size(cls, dim):
+        return cls.SLOT_HEADER_SIZE + (dim[0] * dim[1] * 3 * 4 + 7) // 8 * 8
+
+    def __init__(self, buf, dim=None, num_slots=None):
+        # with dim and num_slots, the header is initialized. otherwise it is read from buf.
+        self._header = np.ndarray((8,), dtype=np.uint64, buffer=buf)
+        if dim is not None:
+            self._header[:] = (self.MAGIC, self.VERSION, dim[0], dim[1], num_slots, 0, 0, 0)
+        elif self._header[0] != self.MAGIC or self._header[1] != self.VERSION:
+            raise RuntimeError('not a version {} walle shared memory segment'.format(self.VERSION))
+        self.dim = (int(self._header[2]), int(self._header[3]))
+        self.num_slots = int(self._header[4])
+        slot_size = self._slot_size(self.dim)
+        shape = (*self.dim, 3)
+        self._slots = []
+        for i in range(self.num_slots + 1):
+            offset = self.HEADER_SIZE + i * slot_size
+            slot_header = np.ndarray((4,), dtype=np.uint64, buffer=buf, offset=offset)
+            frames = [np.ndarray(shape, dtype=dtype, buffer=buf,
+                                 offset=offset + self.SLOT_HEADER_SIZE) for dtype in self.DTYPES]
+            self._slots.append((slot_header, frames))
+
+    def num_published(self):
+        return int(self._header[5])
+
+    def publish(self, frame):
+        # client side
+        n = self.num_published()
+        slot_header, frames = self._slots[1 + n % self.num_slots]
+        code = self.DTYPES.index(frame.dtype)
+        slot_header[0] += 1
+        slot_header[1] = n
+        slot_header[2] = code
+        np.copyto(frames[code], frame)
+        slot_header[0] += 1
+        self._header[5] = n + 1
+
+    def read(self, n):
+        """
+        server side: returns a copy of frame n, or None if it has already been overwritten
+        """
+        slot_header, frames = self._slots[1 + n % self.num_slots]
+        for _ in range(self.MAX_READ_TRIES):
+            seq = int(slot_header[0])
+            if seq % 2 == 0:
+                if slot_header[1] != n:
+                    return None
+                frame = frames[int(slot_header[2])].copy()
+                if int(slot_header[0]) == seq:
+                    return frame
+            os.sched_yield()
+        raise TimeoutError('shared memory frame {} stayed locked'.format(n))
+
+    def write_state(self, frame):
+        # server side
+        slot_header, frames = self._slots[0]
+        slot_header[0] += 1
+        np.copyto(frames[0], frame)
+        slot_header[0] += 1
+
+    def read_state(self):
+        # client side
+        slot_header, frames = self._slots[0]
+        for _ in range(self.MAX_READ_TRIES):
+            seq = int(slot_header[0])
+            if seq % 2 == 0:
+                frame = frames[0].copy()
+                if int(slot_header[0]) == seq:
+                    return frame
+            os.sched_yield()
+        raise TimeoutError('shared memory display state stayed locked')
+
+_shm_segments_created = set()
+
+def _shm_paths(name):
+    # the shared memory segment name and the wakeup FIFO path
+    return 'walle-{}'.format(name), os.path.join(tempfile.gettempdir(), 'walle-{}.fifo'.format(name))
+
+class SharedMemoryLedDisplay:
+    """
+    client for a display server on the same machine listening on shared memory (--listen
+    shm:name). frames are copied straight into a ring in the shared segment, with no packing or
+    sockets, and the server is woken through a FIFO.
+
+    there must be only one client per name, since the ring has a single writer. frames are never
+    acknowledged; get() reads the display state the server publishes to the segment.
+    """
+    def __init__(self, name=DEFAULT_SHM_NAME):
+        shm_name, fifo_path = _shm_paths(name)
+        try:
+            self._shm = shared_memory.SharedMemory(shm_name)
+        except FileNotFoundError:
+            raise RuntimeError('no display server listening on shm:{}'.format(name))
+        # attaching registers the segment with this process's resource tracker, which would unlink
+        # it at exit out from under the server (unless the server is this process)
+        if shm_name not in _shm_segments_created:
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self._ring = _SharedFrameRing(self._shm.buf)
+        self._fifo = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+        self._set_period_profiler = PeriodProfiler('display set', log)
+        log.info('using {}x{} display at shm:{}'.format(*reversed(self._ring.dim), name))
+
+    def set(self, matrix):
+        self._set_period_profiler.mark()
+        frame = as_frame(matrix)
+        assert frame.shape[:2] == self._ring.dim
+        self._ring.publish(frame)
+        try:
+            os.write(self._fifo, b'\0')
+        except BlockingIOError:
+            # the FIFO is full of wakeups the server hasn't got to yet, so it will see this frame
+            pass
+
+    def get(self):
+        return self._ring.read_state()
+
+    def dim(self):
+        return self._ring.dim
+
+    def close(self):
+        os.close(self._fifo)
+        self._ring = None
+        self._shm.close()
+
+class _SharedMemoryListener:
+    """
+    server side of SharedMemoryLedDisplay. it owns the shared memory segment and the wakeup FIFO.
+    """
+    MAX_REQUESTS_PER_RECEIVE = 1000
+    def __init__(self, name, dim, num_slots=_SharedFrameRing.DEFAULT_NUM_SLOTS):
+        assert num_slots > 0
+        self._addr = _SharedMemoryAddr(name)
+        shm_name, self._fifo_path = _shm_paths(name)
+
+        # clean up after a server that didn't exit cleanly
+        try:
+            stale = shared_memory.SharedMemory(shm_name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        if os.path.exists(self._fifo_path):
+            os.unlink(self._fifo_path)
+
+        self._shm = shared_memory.SharedMemory(shm_name, create=True,
+                                               size=_SharedFrameRing.size(dim, num_slots))
+        _shm_segments_created.add(shm_name)
+        self._ring = _SharedFrameRing(self._shm.buf, dim, num_slots)
+        os.mkfifo(self._fifo_path)
+        # holding a write end too keeps the FIFO from reading as EOF while no client has it open
+        self._fifo = os.open(self._fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        self._fifo_keepalive = os.open(self._fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+        self._num_received = 0
+
+    def fileno(self):
+        return self._fifo
+
+    def receive(self):
+        """
+        returns a request for each frame published since the last call (up to
+        MAX_REQUESTS_PER_RECEIVE of the newest). like a batch of datagrams, only the last one gets
+        actuated, so they all carry the newest frame and the rest count as skipped.
+        """
+        try:
+            while os.read(self._fifo, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        num_published = self._ring.num_published()
+        matrix = None
+        while matrix is None and self._num_received < num_published:
+            # the newest frame can be overwritten while it is being read, if the client laps the
+            # ring. start over from whatever is newest then.
+            matrix = self._ring.read(num_published - 1)
+            if matrix is None:
+                num_published = self._ring.num_published()
+        first = max(self._num_received, num_published - self.MAX_REQUESTS_PER_RECEIVE)
+        self._num_received = num_published
+        return [_Request(self._addr, matrix, n % 2**32, None, None, 0, 0, None)
+                for n in range(first, num_published)]
+
+    def publish_state(self, frame):
+        self._ring.write_state(frame_to_float(frame))
+
+    def close(self):
+        os.close(self._fifo)
+        os.close(self._fifo_keepalive)
+        os.unlink(self._fifo_path)
+        self._ring = None
+        self._shm.close()
+        self._shm.unlink()
+
+def _format_addr(addr):
+    if isinstance(addr, _SharedMemoryAddr):
+        return 'shm:{}'.format(addr.name)
+    if isinstance(addr, tuple):
+        return '{}:{}'.format(*addr[:2])
+    return 'unix:{}'.format(addr or '(unbound)')
+
+class _DisplayRequestHandler:
+    """
+    The transport-independent half of the display servers. Requests are parsed as they are
+    received, then handled in batches: every request in a batch is acknowledged, but only the
+    freshest display update is actuated.
+
+    Requests are acknowledged in the protocol version they were received in, so v1 and v2 clients
+    can share a server.
+    """
+    MAX_DELTA_CLIENTS = 64
+    MAX_UPDATE_CLIENTS = 64
+    MAX_KEYFRAMES_PER_CLIENT = 4
+    MAX_CLIPS = 32
+    MAX_CLIP_BYTES = 64 * 2**20
+    MAX_CLIP_UPLOADS = 4
+    MAX_BUFFERED_FRAMES = 64
+    MAX_PRESENTATION_DELAY = 2.
+
+    def __init__(self, driver, max_datagram_size=DEFAULT_MAX_DATAGRAM_SIZE):
         self._driver = driver
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._socket.bind(host_port)
+        self._max_datagram_size = max_datagram_size
+        # the biggest messages are 16-bit frames and clip (part)s, either maybe with a timestamp
+        num_rows, num_cols = driver.dim()
+        self._reassembler = _V2Reassembler(max_message_size=_V2_TIMESTAMP.size + max(
+                6 * num_rows * num_cols, max(_V2_CLIP_HEADER.size, _V2_CLIP_PART.size) +
+                _V2_CLIP_PART_SIZE))
+        self._client_keyframes = {} # client_addr -> {msg_seq: quantized channels}
+        self._ack_templates = {} # (version, channel_bits) -> acks of the current display state
+        self._clips = {} # clip id -> _Clip, least recently used first
+        self._clip_bytes = 0
+        self._clip_uploads = {} # client_addr -> (clip id, clip body size, body received so far)
+        self._playing = None # (clip, loop, start time) of the clip being played
+        self._clip_frame_index = None
+        self._jitter_buffer = [] # heap of (presentation time, arrival order, matrix)
+        self._num_buffered = 0
         self._last_update_client = None
-        self._last_update_msg_seq = None
+        self._update_client_msg_seqs = {} # client_addr -> last msg_seq, least recent first
+        self._counts = dict.fromkeys(('requests', 'malformed', 'actuated', 'skipped', 'repeated',
+                                      'missing', 'timeouts', 'late', 'overflowed'), 0)
         self._set_period_profiler = PeriodProfiler('display set', log)
-        self._select_time_profiler = IntervalProfiler('select wait', log)
-        self._request_time_profiler = IntervalProfiler('request handling', log)
+        self._parse_span = TraceSpan('parse')
+        self._driver_set_span = TraceSpan('driver set')
+        self._ack_span = TraceSpan('ack')
+
+    def parse(self, data, client_addr, sendto):
+        """
+        returns the parsed _Request, or None if the data is malformed or a fragment of a message
+        that is not complete yet. sendto(data, client_addr) is how the request will be acknowledged.
+        """
+        self._parse_span.start()
+        try:
+            return self._parse_request_data(data, client_addr, sendto)
+        except RuntimeError as e:
+            self._counts['malformed'] += 1
+            log.warning('{} request malformed: {}'.format(_format_addr(client_addr), e))
+            return None
+        finally:
+            self._parse_span.stop()
+
+    def counts(self):
+        """
+        returns running totals of the requests handled: complete requests, malformed datagrams, and
+        display updates actuated, skipped in favor of a fresher one, repeated, missing (gaps in an
+        update client's sequence numbers) and timed out. timestamped frames can also be dropped for
+        arriving after their presentation time (late) or for not fitting in the jitter buffer
+        (overflowed).
+        """
+        return dict(self._counts)
 
-    def _parse_request_data(self, data):
+    def _parse_request_data(self, data, client_addr, sendto):
         # parse the request and validate the matrix, if present
-        matrix, msg_seq = _unpack_udp(data)
-        if matrix:
+        if _is_v2(data):
+            message = self._reassembler.add(client_addr, data)
+            if message is None:
+                return None
+            matrix, ack_flags, clip_play = self._decode_v2_request(message, client_addr)
+            msg_seq, version, channel_bits = message.msg_seq, PROTOCOL_V2, message.channel_bits
+            flags = message.flags
+            presentation_t = None
+            if message.timestamp is not None:
+                # the jitter buffer runs on perf_counter(), like the rest of the server's timing
+                presentation_t = message.timestamp - time.time() + time.perf_counter()
+        else:
+            matrix, msg_seq = _unpack_udp(data)
+            version, channel_bits, flags, ack_flags, clip_play = PROTOCOL_V1, None, 0, 0, None
+            presentation_t = None
+            # v1 acks echo the whole display as floats, which stops fitting in a UDP datagram past
+            # about 74x74 (unix socket clients have no such limit)
+            ack_size = 12 + 12 * self._driver.dim()[0] * self._driver.dim()[1]
+            if sendto is not None and isinstance(client_addr, tuple) and \
+               ack_size > _MAX_V1_DATAGRAM_SIZE:
+                raise RuntimeError('display too large to acknowledge v1 requests ({} byte ack), use '
+                                   'protocol v2'.format(ack_size))
+        if matrix is not None:
             dim = _get_dim(matrix)
             if dim != self._driver.dim():
                 raise RuntimeError('incorrect dimensions {}x{}'.format(*dim))
-        return (matrix, msg_seq)
+        return _Request(client_addr, matrix, msg_seq, version, channel_bits, flags, ack_flags,
+                        sendto, clip_play, presentation_t)
+
+    def _decode_v2_request(self, message, client_addr):
+        # returns the request's matrix (if any), the flags to acknowledge it with, and the clip to
+        # play as (clip id, clip, loop), if any. the clip itself is kept, since it may be evicted
+        # by later requests in the same batch before it is started
+        if message.encoding == _V2_ENCODING_NONE:
+            return None, 0, None
+        elif message.encoding == _V2_ENCODING_FULL:
+            chs = _decode_v2_channels(message)
+            if message.flags & _V2_FLAG_KEYFRAME:
+                self._store_keyframe(client_addr, message.msg_seq, chs)
+            return _quantized_to_frame(chs, message.channel_bits), 0, None
+        elif message.encoding == _V2_ENCODING_CLIP:
+            self._store_clip(message)
+            return None, 0, None
+        elif message.encoding == _V2_ENCODING_CLIP_PART:
+            self._store_clip_part(client_addr, message)
+            return None, 0, None
+        elif message.encoding == _V2_ENCODING_CLIP_PLAY:
+            clip_id, loop = _V2_CLIP_PLAY.unpack(message.body)
+            if clip_id not in self._clips:
+                log.info('{} asked to play unknown clip {:08x}'.format(_format_addr(client_addr),
+                                                                       clip_id))
+                return None, _V2_FLAG_NEED_CLIP, None
+            return None, 0, (clip_id, self._clips[clip_id], bool(loop))
+
+        # deltas can only be applied against a keyframe this client sent earlier. if it is gone
+        # (e.g., evicted, or this server restarted), ask the client for a new one.
+        ref_seq = _v2_delta_ref_seq(message)
+        ref_chs = self._client_keyframes.get(client_addr, {}).get(ref_seq)
+        if ref_chs is None or ref_chs.shape[:2] != message.dim or \
+           ref_chs.itemsize != _V2_CHANNEL_DTYPES[message.channel_bits].itemsize:
+            log.debug('{} delta {} against unknown keyframe {}'.format(_format_addr(client_addr),
+                    message.msg_seq, ref_seq))
+            return None, _V2_FLAG_NEED_KEYFRAME, None
+        chs = _apply_v2_delta(message, ref_chs)
+        return _quantized_to_frame(chs, message.channel_bits), 0, None
+
+    def _store_clip(self, message):
+        if message.dim != self._driver.dim():
+            raise RuntimeError('incorrect clip dimensions {}x{}'.format(*message.dim))
+        if len(message.body) > self.MAX_CLIP_BYTES:
+            raise RuntimeError('{}-byte clip is too big'.format(len(message.body)))
+        clip_id, num_frames, period_us = _V2_CLIP_HEADER.unpack_from(message.body)
+        chs = np.frombuffer(message.body, dtype=_V2_CHANNEL_DTYPES[message.channel_bits],
+                            offset=_V2_CLIP_HEADER.size).reshape(num_frames, *message.dim, 3)
+        clip = _Clip(_quantized_to_frame(chs, message.channel_bits), period_us / 1e6,
+                     len(message.body))
+
+        # re-inserting keeps the dict ordered by recency, so the least recently used clip is evicted
+        old = self._clips.pop(clip_id, None)
+        if old is not None:
+            self._clip_bytes -= old.size
+        self._clips[clip_id] = clip
+        self._clip_bytes += clip.size
+        while len(self._clips) > self.MAX_CLIPS or self._clip_bytes > self.MAX_CLIP_BYTES:
+            evicted = self._clips.pop(next(iter(self._clips)))
+            self._clip_bytes -= evicted.size
+        log.info('stored clip {:08x}: {} frames every {:.3f} s'.format(clip_id, num_frames,
+                                                                       clip.period))
+
+    def _store_clip_part(self, client_addr, message):
+        # parts come in order, since the client waits for each one's ack before sending the next. a
+        # part is resent when its ack is lost, so repeats of what was already received are fine.
+        clip_id, offset, size = _V2_CLIP_PART.unpack_from(message.body)
+        part = message.body[_V2_CLIP_PART.size:]
+        if size > self.MAX_CLIP_BYTES:
+            raise RuntimeError('{}-byte clip is too big'.format(size))
+        upload = self._clip_uploads.get(client_addr)
+        if offset == 0:
+            upload = (clip_id, size, bytearray())
+        elif upload is None and clip_id in self._clips and offset + len(part) == size:
+            # the last part again: the clip is already stored
+            return
+        if upload is None or upload[:2] != (clip_id, size) or offset > len(upload[2]):
+            raise RuntimeError('clip {:08x} part at {} out of order'.format(clip_id, offset))
+        body = upload[2]
+        if offset == len(body):
+            body += part
+
+        # re-inserting keeps the dict ordered by recency, so the stalest upload is evicted
+        self._clip_uploads.pop(client_addr, None)
+        if len(body) == size:
+            self._store_clip(_validate_v2_message(message._replace(encoding=_V2_ENCODING_CLIP,
+                                                                   body=body)))
+            return
+        self._clip_uploads[client_addr] = upload
+        while len(self._clip_uploads) > self.MAX_CLIP_UPLOADS:
+            del self._clip_uploads[next(iter(self._clip_uploads))]
+
+    def _start_clip(self, clip_id, clip, loop):
+        # playing counts as a use, for the LRU, if the clip is still stored
+        stored = self._clips.pop(clip_id, None)
+        if stored is not None:
+            self._clips[clip_id] = stored
+        self._playing = (clip, loop, time.perf_counter())
+        self._clip_frame_index = None
+        self._play_clip(time.perf_counter())
+
+    def _buffer_frame(self, request):
+        now = time.perf_counter()
+        if request.presentation_t < now:
+            self._counts['late'] += 1
+            log.debug('{} request {} late by {:.1f} ms'.format(_format_addr(request.client_addr),
+                      request.msg_seq, 1e3 * (now - request.presentation_t)))
+            return
+        if request.presentation_t > now + self.MAX_PRESENTATION_DELAY:
+            early = request.presentation_t - now
+            log.warning('{} request {} is {:.1f} s early, showing it now'.format(
+                    _format_addr(request.client_addr), request.msg_seq, early))
+            presentation_t = now
+        else:
+            presentation_t = request.presentation_t
+        if len(self._jitter_buffer) >= self.MAX_BUFFERED_FRAMES:
+            # the buffer is in heap order, so this drops the frame due soonest
+            heapq.heappop(self._jitter_buffer)
+            self._counts['overflowed'] += 1
+        heapq.heappush(self._jitter_buffer, (presentation_t, self._num_buffered, request.matrix))
+        self._num_buffered += 1
+
+    def tick(self, now):
+        """
+        shows whatever is due at time now (a perf_counter() time): buffered frames and the frames
+        of the playing clip. returns when something is next due, or None if nothing is pending.
+        servers call this after handling requests and whenever the previous deadline comes up.
+        """
+        deadlines = [t for t in (self._present_buffered(now), self._play_clip(now)) if t is not None]
+        return min(deadlines) if deadlines else None
+
+    def _present_buffered(self, now):
+        # shows the latest buffered frame that is due. any others that are due were superseded.
+        due = None
+        while self._jitter_buffer and self._jitter_buffer[0][0] <= now:
+            if due is not None:
+                self._counts['skipped'] += 1
+            due = heapq.heappop(self._jitter_buffer)[2]
+        if due is not None:
+            self._playing = None
+            try:
+                self._set_period_profiler.mark()
+                self._driver_set(due)
+                self._counts['actuated'] += 1
+            except TimeoutError as e:
+                self._counts['timeouts'] += 1
+                log.error('timeout setting display from jitter buffer: {}'.format(e))
+        return self._jitter_buffer[0][0] if self._jitter_buffer else None
+
+    def _play_clip(self, now):
+        # shows whichever frame of the playing clip is due. late frames are skipped, so the clip
+        # keeps its timing.
+        if self._playing is None:
+            return None
+        clip, loop, start = self._playing
+        num_periods = int((now - start) / clip.period)
+        if loop:
+            index = num_periods % len(clip.frames)
+        else:
+            index = min(num_periods, len(clip.frames) - 1)
+        if index != self._clip_frame_index:
+            self._clip_frame_index = index
+            try:
+                self._driver_set(clip.frames[index])
+                self._counts['actuated'] += 1
+            except TimeoutError as e:
+                self._counts['timeouts'] += 1
+                log.error('timeout setting display from clip: {}'.format(e))
+        if not loop and index == len(clip.frames) - 1:
+            self._playing = None
+            return None
+        return start + (num_periods + 1) * clip.period
+
+    def _store_keyframe(self, client_addr, msg_seq, chs):
+        keyframes = self._client_keyframes.pop(client_addr, {})
+        keyframes[msg_seq] = chs.astype(chs.dtype.newbyteorder('='), copy=False)
+        while len(keyframes) > self.MAX_KEYFRAMES_PER_CLIENT:
+            del keyframes[next(iter(keyframes))]
+        # re-inserting keeps the dict ordered by recency, so the stalest client is evicted
+        self._client_keyframes[client_addr] = keyframes
+        while len(self._client_keyframes) > self.MAX_DELTA_CLIENTS:
+            del self._client_keyframes[next(iter(self._client_keyframes))]
+
+    def _pack_ack(self, request):
+        """
+        acks echo the current display state, which only changes when an update is actuated. so the
+        acks are packed once per display state (and format) and reused, with just the header
+        patched for each request.
 
-    def _process_requests(self):
-        # parse all pending requests, keeping track of the last one that actually requests a display
-        # update
-        requests = []
-        num_recv = 0
+        note: the returned datagrams are shared and get patched again by the next call, which is
+        fine since sendto() copies them (asyncio included, even when it has to buffer).
+        """
+        if request.flags & _V2_FLAG_CLOCK:
+            # timestamped acks can't use the templates, since the timestamp shifts the body
+            flags = request.ack_flags | _V2_FLAG_TIMESTAMP
+            body = _V2_TIMESTAMP.pack(time.time())
+            if request.flags & _V2_FLAG_ACK_ONLY:
+                return _fragment_v2(body, request.msg_seq, _V2_ENCODING_NONE, request.channel_bits,
+                                    (0, 0), flags)
+            frame = self._driver.get()
+            return _fragment_v2(body + _encode_v2_frame(frame, request.channel_bits),
+                                request.msg_seq, _V2_ENCODING_FULL, request.channel_bits,
+                                _get_dim(frame), flags, self._max_datagram_size)
+        if request.flags & _V2_FLAG_ACK_ONLY:
+            return _pack_v2(None, request.msg_seq, request.channel_bits, flags=request.ack_flags)
+
+        key = (request.version, request.channel_bits)
+        acks = self._ack_templates.get(key)
+        if acks is None:
+            if request.version == PROTOCOL_V1:
+                packed = [_pack_udp(self._driver.get(), 0)]
+            else:
+                packed = _pack_v2(self._driver.get(), 0, request.channel_bits,
+                                  max_datagram_size=self._max_datagram_size)
+            acks = self._ack_templates[key] = [bytearray(ack) for ack in packed]
+
+        for ack in acks:
+            if request.version == PROTOCOL_V1:
+                struct.pack_into('>I', ack, 0, request.msg_seq)
+            else:
+                struct.pack_into('>BI', ack, _V2_FLAGS_OFFSET, request.ack_flags, request.msg_seq)
+        return acks
+
+    def _driver_set(self, matrix):
+        self._ack_templates.clear()
+        self._driver_set_span.start()
+        self._driver.set(matrix)
+        self._driver_set_span.stop()
+
+    def process(self, requests):
+        # keep track of the last request that actually requests an immediate display update (a
+        # frame or a clip to play). timestamped frames go to the jitter buffer instead.
         last_update_request = None
-        while num_recv < 10:
-            # break out if there are no more pending messages
-            readers, _, _ = select.select([self._socket], [], [], 0)
-            if not readers:
-                break
-
-            # receive and parse the pending message
-            (data, client_addr) = self._socket.recvfrom(4096)
-            num_recv += 1
-            try:
-                matrix, msg_seq = self._parse_request_data(data)
-                request = (client_addr, matrix, msg_seq)
-                requests.append(request)
-                if matrix:
-                    last_update_request = request
-            except RuntimeError as e:
-                log.warning('{}:{} request malformed: {}'.format(*client_addr, e))
+        for request in requests:
+            if (request.matrix is not None and request.presentation_t is None) or \
+               request.clip_play is not None:
+                last_update_request = request
 
         # acknowledge all requests, but only actuate the last update request as an optimization
+        self._counts['requests'] += len(requests)
         for request in requests:
-            client_addr, matrix, msg_seq = request
+            client_addr, matrix, msg_seq = request[:3]
 
-            # perform processing for requests containing a matrix
-            if matrix:
+            # perform processing for requests containing a matrix or clip
+            if matrix is not None or request.clip_play is not None:
                 # record any new client sending display updates. I guess this could cause some spam
                 # if there are lots of client changes...
                 if self._last_update_client != client_addr:
-                    log.info('new update client {}:{}'.format(*client_addr))
+                    log.info('new update client {}'.format(_format_addr(client_addr)))
                     self._last_update_client = client_addr
-                    self._last_update_msg_seq = None
 
-                # detect missing messages (for fun)
-                if self._last_update_msg_seq is not None:
-                    if msg_seq == self._last_update_msg_seq:
-                        log.debug('{}:{} repeated message {}'.format(*client_addr, msg_seq))
-                    elif msg_seq != (self._last_update_msg_seq + 1) % 2**32:
-                        log.warning('{}:{} requests missing between {} and {}'.format(*client_addr,
-                                self._last_update_msg_seq, msg_seq))
-                self._last_update_msg_seq = msg_seq
+                # detect missing messages (for fun). each client numbers its own messages, so the
+                # last msg_seq is tracked per client.
+                last_msg_seq = self._update_client_msg_seqs.pop(client_addr, None)
+                if last_msg_seq is not None:
+                    if msg_seq == last_msg_seq:
+                        self._counts['repeated'] += 1
+                        log.debug('{} repeated message {}'.format(_format_addr(client_addr),
+                                                                  msg_seq))
+                    elif msg_seq != (last_msg_seq + 1) % 2**32:
+                        self._counts['missing'] += (msg_seq - last_msg_seq - 1) % 2**32
+                        log.warning('{} requests missing between {} and {}'.format(
+                                _format_addr(client_addr), last_msg_seq, msg_seq))
+                # re-inserting keeps the dict ordered by recency, so the stalest client is evicted
+                self._update_client_msg_seqs[client_addr] = msg_seq
+                while len(self._update_client_msg_seqs) > self.MAX_UPDATE_CLIENTS:
+                    del self._update_client_msg_seqs[next(iter(self._update_client_msg_seqs))]
 
                 # if this request is the freshest update request in the queue, actuate it.
                 # otherwise, log that the message was skipped
-                if request is last_update_request:
+                if request.presentation_t is not None and matrix is not None:
+                    self._buffer_frame(request)
+                elif request is last_update_request and request.clip_play is not None:
+                    self._start_clip(*request.clip_play)
+                elif request is last_update_request:
+                    # a live frame stops any clip that was playing
+                    self._playing = None
                     try:
                         self._set_period_profiler.mark()
-                        self._driver.set(matrix)
+                        self._driver_set(matrix)
+                        self._counts['actuated'] += 1
                     except TimeoutError as e:
-                        # TODO: can delete this timeout after we make set() asynchronous
-                        # also, note that we will acknowledge this request even though it timed
-                        # out, which is weird
-                        log.error('{}:{} request timeout setting display: {}'.format(*client_addr, e))
+                        self._counts['timeouts'] += 1
+                        # LocalLedDisplay writes asynchronously, so this only happens when proxying
+                        # to another network display. note that we will acknowledge this request
+                        # even though it timed out, which is weird
+                        log.error('{} request timeout setting display: {}'.format(
+                                _format_addr(client_addr), e))
                 else:
-                    log.debug('{}:{} request {} skipped'.format(*client_addr, msg_seq))
+                    self._counts['skipped'] += 1
+                    log.debug('{} request {} skipped'.format(_format_addr(client_addr), msg_seq))
+            elif client_addr in self._update_client_msg_seqs:
+                # update clients' other requests (clip uploads, queries) use up msg_seqs too
+                self._update_client_msg_seqs[client_addr] = msg_seq
+
+            # all valid requests are acknowledged, unless there is no way to reach the client (an
+            # unbound unix socket) or the transport doesn't use acks (shared memory)
+            if client_addr and request.sendto is not None:
+                self._ack_span.start()
+                try:
+                    for ack in self._pack_ack(request):
+                        request.sendto(ack, client_addr)
+                except OSError as e:
+                    # e.g. the client went away. the client will retry, so just carry on
+                    log.warning('{} request {} ack failed: {}'.format(_format_addr(client_addr),
+                                                                     msg_seq, e))
+                self._ack_span.stop()
+
+class _UdpLedDisplayServer:
+    """
+    This was originally implemented as a synchronous socketserver.UDPServer, but became concerned
+    about requests backing up in OS buffers. This version only serves the most recent request in the
+    RX buffers.
+    """
+    MAX_REQUESTS_PER_WAKEUP = 10
+    MAX_DATAGRAMS_PER_WAKEUP = 1000
+
+    def __init__(self, host_port, driver, max_datagram_size=DEFAULT_MAX_DATAGRAM_SIZE):
+        self._handler = _DisplayRequestHandler(driver, max_datagram_size)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(host_port)
+        self._select_time_profiler = IntervalProfiler('select wait', log)
+        self._request_time_profiler = IntervalProfiler('request handling', log)
+        self._num_wakeups = 0
+        self._num_capped_wakeups = 0
+
+    def counts(self):
+        """
+        the request handler's counts, plus the number of wakeups and how many of them stopped
+        draining at MAX_REQUESTS_PER_WAKEUP or MAX_DATAGRAMS_PER_WAKEUP (i.e. the server is falling
+        behind)
+        """
+        counts = self._handler.counts()
+        counts.update(wakeups=self._num_wakeups, capped_wakeups=self._num_capped_wakeups)
+        return counts
+
+    def _process_requests(self):
+        # parse all pending requests
+        requests = []
+        num_datagrams = 0
+        while len(requests) < self.MAX_REQUESTS_PER_WAKEUP and \
+              num_datagrams < self.MAX_DATAGRAMS_PER_WAKEUP:
+            # break out if there are no more pending messages
+            readers, _, _ = select.select([self._socket], [], [], 0)
+            if not readers:
+                break
+
+            # receive and parse the pending message. only complete messages count as requests.
+            (data, client_addr) = self._socket.recvfrom(_MAX_RECV_SIZE)
+            num_datagrams += 1
+            request = self._handler.parse(data, client_addr, self._socket.sendto)
+            if request is not None:
+                requests.append(request)
 
-            # all valid requests are acknowledged
-            ack = _pack_udp(self._driver.get(), msg_seq)
-            self._socket.sendto(ack, client_addr)
+        self._num_wakeups += 1
+        if len(requests) >= self.MAX_REQUESTS_PER_WAKEUP or \
+           num_datagrams >= self.MAX_DATAGRAMS_PER_WAKEUP:
+            self._num_capped_wakeups += 1
+        self._handler.process(requests)
 
     def serve_forever(self):
+        deadline = None
         while True:
-            # wait for the socket to have pending data, then process the pending requests
+            # wait for the socket to have pending data (or for the next buffered or clip frame
+            # to be due), then process the pending requests
+            timeout = None if deadline is None else max(deadline - time.perf_counter(), 0.)
             with self._select_time_profiler.measure():
-                readers, _, _ = select.select([self._socket], [], [])
-            with self._request_time_profiler.measure():
-                self._process_requests()
+                readers, _, _ = select.select([self._socket], [], [], timeout)
+            if readers:
+                with self._request_time_profiler.measure():
+                    self._process_requests()
+            deadline = self._handler.tick(time.perf_counter())
+
+class _DatagramServerProtocol(asyncio.DatagramProtocol):
+    """
+    feeds an _AsyncLedDisplayServer from a datagram socket (UDP or unix)
+    """
+    def __init__(self, server, sock):
+        self._server = server
+        self._socket = sock
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        self._server.submit(data, addr, self._transport.sendto)
+
+        # asyncio hands over only one datagram per wakeup. read whatever else is already queued
+        # right away, so the whole backlog is handled as one batch.
+        for _ in range(self._server.MAX_DRAIN_PER_WAKEUP):
+            try:
+                data, addr = self._socket.recvfrom(_MAX_RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            self._server.submit(data, addr, self._transport.sendto)
+
+    def error_received(self, exc):
+        log.warning('socket error: {}'.format(exc))
+
+class _AsyncLedDisplayServer:
+    """
+    asyncio version of _UdpLedDisplayServer. it can listen on any number of UDP addresses and unix
+    datagram sockets at once. every datagram that is ready when the event loop wakes up is drained
+    and handled as one batch, so like the select server only the freshest update gets actuated, but
+    without the 10-request cap that leaves a backlog behind when there are many clients.
+
+    transports deliver datagrams through submit(), so other transports (e.g. TCP streams) can be
+    added by calling it from their own protocol. shared memory listeners hand over already-parsed
+    requests instead.
+    """
+    MAX_DRAIN_PER_WAKEUP = 10000
+
+    def __init__(self, driver, max_datagram_size=DEFAULT_MAX_DATAGRAM_SIZE):
+        self._handler = _DisplayRequestHandler(driver, max_datagram_size)
+        self._pending = []
+        self._transports = []
+        self._shm_listeners = []
+        self._num_actuated = None
+        self._tick_timer = None
+        self._request_time_profiler = IntervalProfiler('request handling', log)
+
+    async def listen_udp(self, host_port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        host, port = host_port
+        if host and _is_multicast(host):
+            # several servers can listen on one group, e.g. walls mirroring a GroupLedDisplay tile
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', port))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(host) + socket.inet_aton('0.0.0.0'))
+            log.info('joined multicast group {}'.format(host))
+        else:
+            sock.bind(host_port)
+        await self._listen_datagram(sock)
+        log.info('listening on udp {}'.format(_format_addr(sock.getsockname())))
+
+    async def listen_unix(self, path):
+        # note: clients must bind their own socket path to receive acknowledgements
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        await self._listen_datagram(sock)
+        log.info('listening on {}'.format(_format_addr(path)))
+
+    async def listen_shm(self, name, num_slots=_SharedFrameRing.DEFAULT_NUM_SLOTS):
+        listener = _SharedMemoryListener(name, self._handler._driver.dim(), num_slots)
+        listener.publish_state(self._handler._driver.get())
+        asyncio.get_running_loop().add_reader(listener.fileno(), self._receive_shm, listener)
+        self._shm_listeners.append(listener)
+        log.info('listening on shm:{}'.format(name))
+
+    def _receive_shm(self, listener):
+        for request in listener.receive():
+            self._enqueue(request)
+
+    async def _listen_datagram(self, sock):
+        sock.setblocking(False)
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _DatagramServerProtocol(self, sock), sock=sock)
+        self._transports.append(transport)
+
+    def submit(self, data, client_addr, sendto):
+        """
+        transport hook: queues a received datagram for the next batch. sendto(data, client_addr)
+        is used to acknowledge it.
+        """
+        self._enqueue(self._handler.parse(data, client_addr, sendto))
+
+    def _enqueue(self, request):
+        self._pending.append(request)
+        if len(self._pending) == 1:
+            asyncio.get_running_loop().call_soon(self._process_pending)
+
+    def counts(self):
+        return self._handler.counts()
+
+    def _process_pending(self):
+        pending, self._pending = self._pending, []
+        with self._request_time_profiler.measure():
+            self._handler.process([request for request in pending if request is not None])
+        self._tick()
+
+    def _tick(self):
+        if self._tick_timer is not None:
+            self._tick_timer.cancel()
+            self._tick_timer = None
+        deadline = self._handler.tick(time.perf_counter())
+        if deadline is not None:
+            self._tick_timer = asyncio.get_running_loop().call_later(
+                    max(deadline - time.perf_counter(), 0.), self._tick)
+        self._publish_state()
+
+    def _publish_state(self):
+        # shared memory clients read the display state from their segment instead of acks
+        if self._shm_listeners:
+            num_actuated = self._handler.counts()['actuated']
+            if num_actuated != self._num_actuated:
+                self._num_actuated = num_actuated
+                state = self._handler._driver.get()
+                for listener in self._shm_listeners:
+                    listener.publish_state(state)
+
+    def close(self):
+        if self._tick_timer is not None:
+            self._tick_timer.cancel()
+            self._tick_timer = None
+        for transport in self._transports:
+            transport.close()
+        self._transports = []
+        for listener in self._shm_listeners:
+            asyncio.get_running_loop().remove_reader(listener.fileno())
+            listener.close()
+        self._shm_listeners = []
+
+    async def serve_forever(self):
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            self.close()
+
+def _is_multicast(host):
+    # hostnames are never multicast groups
+    try:
+        return ipaddress.ip_address(host).is_multicast
+    except ValueError:
+        return False
+
+def _parse_listen_addr(addr):
+    # 'unix:path', 'shm:name', or '[host:]port'
+    if addr.startswith('unix:'):
+        return 'unix', addr[len('unix:'):]
+    if addr.startswith('shm:'):
+        return 'shm', addr[len('shm:'):] or DEFAULT_SHM_NAME
+    host, _, port = addr.rpartition(':')
+    return 'udp', (host, int(port))
+
+async def _serve_async(driver, listen_addrs):
+    server = _AsyncLedDisplayServer(driver)
+    for kind, addr in listen_addrs:
+        if kind == 'unix':
+            await server.listen_unix(addr)
+        elif kind == 'shm':
+            await server.listen_shm(addr)
+        else:
+            await server.listen_udp(addr)
+    await server.serve_forever()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('target', type=str, help='The display to connect to')
     parser.add_argument('--listen_port', type=int, default=4513, help='UDP server listen port')
+    parser.add_argument('--listen', type=str, action='append', default=[],
+                        help='Additional listen address, [host:]port, unix:path or shm:name '
+                             '(implies --asyncio). a UDP address on --listen_port replaces the '
+                             'default listener')
+    parser.add_argument('--asyncio', action='store_true', default=False,
+                        help='Serve with asyncio instead of a select loop')
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help='Serve Prometheus stats over HTTP on this port')
+    parser.add_argument('--metrics_file', type=str, default=None,
+                        help='Dump Prometheus stats to this file on SIGUSR1')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='Record a trace and dump it to this file (Chrome trace JSON) on '
+                             'SIGUSR2 and at exit')
+    parser.add_argument('--trace_capacity', type=int, default=65536,
+                        help='Number of most recent trace events to keep')
     args = parser.parse_args()
 
+    if args.metrics_port is not None:
+        serve_prometheus(args.metrics_port)
+    if args.metrics_file:
+        dump_prometheus_on_signal(args.metrics_file)
+    if args.trace:
+        enable_tracing(args.trace_capacity, args.trace)
+
     driver = create_display(args.target)
-    server = _UdpLedDisplayServer(('', args.listen_port), driver)
-    log.info('listening on :{}'.format(args.listen_port))
-    server.serve_forever()
+    if args.asyncio or args.listen:
+        listen_addrs = [_parse_listen_addr(addr) for addr in args.listen]
+        # the default listener would take the port from a listener on a specific address, or (for a
+        # multicast group, whose socket is bound to all addresses) receive its datagrams twice
+        if not any(kind == 'udp' and addr[1] == args.listen_port for kind, addr in listen_addrs):
+            listen_addrs.insert(0, ('udp', ('', args.listen_port)))
+        asyncio.run(_serve_async(driver, listen_addrs))
+    else:
+        server = _UdpLedDisplayServer(('', args.listen_port), driver)
+        log.info('listening on :{}'.format(args.listen_port))
+        server.serve_forever()
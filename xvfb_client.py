@@ -2,6 +2,7 @@
 
 import argparse
 import io
+import numpy
 import os
 from PIL import Image
 import subprocess
@@ -27,9 +28,8 @@ def bmp2matrix(bmp, matrix_dim):
     if img.size != matrix_dim:
         img = img.resize(matrix_dim, resample=Image.LANCZOS)
     assert img.size == matrix_dim
-    return [[tuple(ch / 255. for ch in img.getpixel((col, row)))
-                for col in range(matrix_dim[0])]
-                    for row in range(matrix_dim[1])]
+    # a uint8 (rows, cols, 3) array is already a native walle frame
+    return numpy.asarray(img.convert('RGB'))
 
 class Xvfb:
     def __init__(self, logger, x_display, x_dim):